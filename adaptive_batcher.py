@@ -0,0 +1,135 @@
+import collections
+import math
+import threading
+import time
+
+import numpy as np
+
+
+class AdaptiveBatcher(object):
+    """Picks how many messages to pull and which attack batch size to use.
+
+    Under backlog it batches as large as the p95 latency target allows, when
+    the queue is quiet it takes whatever is there so single requests are not
+    held back. Per-step attack times are learned per batch size from
+    `observe_attack`, and end-to-end latencies from `observe_latency` scale
+    the estimate down when the observed p95 drifts over the target.
+
+    Every batch size is run once, as soon as the backlog can fill it, before
+    its step time is extrapolated; until then step time is assumed to grow
+    as batch_size ** `scaling`, since a batched step costs less than the
+    same steps run one image at a time.
+    """
+
+    # exponent of the step time prior for batch sizes not measured yet
+    SCALING = 0.75
+
+    def __init__(self, sqs, queue_url, latency_target=30.0, max_messages=10, batch_sizes=(1, 2, 4),
+                 default_step_time=0.5, default_steps=45, overhead=2.0, refresh=5.0, window=200,
+                 scaling=SCALING):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.latency_target = latency_target
+        self.max_messages = max_messages
+        self.batch_sizes = sorted(batch_sizes)
+        self.default_step_time = default_step_time
+        self.steps = default_steps
+        self.overhead = overhead
+        self.refresh = refresh
+        self.scaling = scaling
+        self.step_times = {}
+        # batch sizes handed out once to be measured
+        self.probed = set()
+        self.faces_per_message = 1.0
+        self.latencies = collections.deque(maxlen=window)
+        self._backlog = 0
+        self._backlog_at = 0.0
+        self._lock = threading.Lock()
+
+    def backlog(self):
+        now = time.time()
+        if now - self._backlog_at > self.refresh:
+            try:
+                response = self.sqs.get_queue_attributes(QueueUrl=self.queue_url,
+                                                         AttributeNames=['ApproximateNumberOfMessages'])
+                self._backlog = int(response['Attributes']['ApproximateNumberOfMessages'])
+            except Exception as e:
+                print("could not read queue depth:", e)
+            self._backlog_at = now
+        return self._backlog
+
+    def observe_attack(self, batch_size, step_time, steps, nb_faces, nb_messages):
+        with self._lock:
+            if step_time is not None:
+                old = self.step_times.get(batch_size)
+                self.step_times[batch_size] = step_time if old is None else 0.8 * old + 0.2 * step_time
+            self.steps = steps
+        self.observe_faces(nb_faces, nb_messages)
+
+    def observe_faces(self, nb_faces, nb_messages):
+        with self._lock:
+            if nb_messages:
+                self.faces_per_message = 0.9 * self.faces_per_message + 0.1 * (nb_faces / nb_messages)
+
+    def observe_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def p95(self):
+        with self._lock:
+            if not self.latencies:
+                return None
+            return float(np.percentile(self.latencies, 95))
+
+    def step_time(self, batch_size):
+        if batch_size in self.step_times:
+            return self.step_times[batch_size]
+        if self.step_times:
+            # scale from the nearest measured size
+            known = min(self.step_times, key=lambda b: abs(b - batch_size))
+            return self.step_times[known] * (batch_size / float(known)) ** self.scaling
+        return self.default_step_time * batch_size ** self.scaling
+
+    def estimate_latency(self, nb_messages, batch_size):
+        nb_faces = max(1, int(math.ceil(nb_messages * self.faces_per_message)))
+        nb_batches = int(math.ceil(nb_faces / batch_size))
+        return self.overhead + nb_batches * self.steps * self.step_time(batch_size)
+
+    def probe(self, wanted):
+        """`(nb_messages, batch_size)` running an unmeasured batch size once,
+        if `wanted` messages are expected to fill it, else None."""
+        for batch_size in self.batch_sizes:
+            if batch_size in self.step_times or batch_size in self.probed:
+                continue
+            nb_messages = max(1, int(math.ceil(batch_size / max(self.faces_per_message, 1e-3))))
+            if nb_messages <= wanted:
+                self.probed.add(batch_size)
+                return nb_messages, batch_size
+        return None
+
+    def plan(self):
+        """Return `(nb_messages, attack_batch_size)` for the next fetch."""
+        budget = self.latency_target
+        p95 = self.p95()
+        if p95 is not None and p95 > self.latency_target:
+            budget = self.latency_target * self.latency_target / p95
+
+        wanted = min(max(self.backlog(), 1), self.max_messages)
+        probe = self.probe(wanted)
+        if probe is not None:
+            return probe
+        best = (1, self.batch_sizes[0])
+        best_throughput = 0.0
+        for nb_messages in range(1, wanted + 1):
+            nb_faces = max(1, nb_messages * self.faces_per_message)
+            for batch_size in self.batch_sizes:
+                # no point padding a graph far beyond the faces we expect
+                if batch_size > 1 and batch_size / 2.0 >= nb_faces:
+                    continue
+                latency = self.estimate_latency(nb_messages, batch_size)
+                if latency > budget and nb_messages > 1:
+                    continue
+                throughput = nb_messages / latency
+                if throughput > best_throughput:
+                    best, best_throughput = (nb_messages, batch_size), throughput
+        return best
@@ -0,0 +1,139 @@
+import collections
+import hashlib
+import os
+import threading
+
+
+class DiskStore(object):
+    """Size-bounded LRU byte store backed by one file per key."""
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        # rebuild the LRU order from what survived the last run
+        existing = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            existing.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(existing):
+            self._entries[name] = size
+            self.total_bytes += size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            self.delete(key)
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmp = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self.total_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def delete(self, key):
+        with self._lock:
+            self.total_bytes -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class CloakCache(object):
+    """Content-addressed cache of cloaked outputs.
+
+    Results are stored under the sha256 of the original image bytes, with
+    the S3 ETag kept as an alias so a hit can be detected before the body is
+    downloaded. `namespace` should identify the protection settings so
+    outputs made with different modes never collide. Any object with
+    `get`/`put`/`delete` of bytes can stand in for DiskStore.
+    """
+
+    def __init__(self, store, namespace="low"):
+        self.store = store
+        self.namespace = namespace
+        self.hits = 0
+        self.etag_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _key(self, kind, value):
+        return "{}-{}-{}".format(self.namespace, kind, value)
+
+    @staticmethod
+    def content_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def _count(self, hit, etag=False):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                if etag:
+                    self.etag_hits += 1
+            else:
+                self.misses += 1
+
+    def lookup_etag(self, etag):
+        """Only looks, a miss here is not counted until `lookup` runs on the
+        downloaded bytes."""
+        if not etag:
+            return None
+        digest = self.store.get(self._key("etag", etag.strip('"')))
+        if digest is None:
+            return None
+        cloaked = self.store.get(self._key("sha256", digest.decode()))
+        if cloaked is not None:
+            self._count(True, etag=True)
+        return cloaked
+
+    def lookup(self, data):
+        cloaked = self.store.get(self._key("sha256", self.content_hash(data)))
+        self._count(cloaked is not None)
+        return cloaked
+
+    def put(self, data, cloaked, etag=None):
+        digest = self.content_hash(data)
+        self.store.put(self._key("sha256", digest), cloaked)
+        if etag:
+            self.store.put(self._key("etag", etag.strip('"')), digest.encode())
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "etag_hits": self.etag_hits,
+                    "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                    "bytes": getattr(self.store, "total_bytes", None),
+                    "evictions": getattr(self.store, "evictions", None)}
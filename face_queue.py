@@ -0,0 +1,87 @@
+import collections
+
+import numpy as np
+
+
+class FaceQueue(object):
+    """Face-level work queue for the attack stage.
+
+    Pipeline items are registered with `put`; every face of every mode group
+    (`group["job"].original_images`) becomes one entry. `take` packs the
+    oldest faces of one mode into a batch regardless of which image or
+    message they came from, and `finish` scatters the cloaks back into each
+    group's `protected` array at the face's position, which is the position
+    `Faces.merge_faces` maps through `callback_idx` and `cropped_index`.
+    An item is returned by `finish` as soon as its last face is done, so it
+    never waits for faces queued after it. Only used from the attack thread.
+    """
+
+    def __init__(self):
+        self.faces = collections.deque()
+
+    def __len__(self):
+        return len(self.faces)
+
+    @staticmethod
+    def count(item):
+        return sum(len(group["job"].original_images) for group in item["groups"])
+
+    def put(self, item):
+        """Queue the faces of `item`; returns how many there are."""
+        item["remaining"] = 0
+        for group in item["groups"]:
+            job = group["job"]
+            group["protected"] = np.zeros(job.original_images.shape, dtype=np.float32)
+            job.iterations = [0] * len(job.original_images)
+            self.faces.extend((item, group, i) for i in range(len(job.original_images)))
+            item["remaining"] += len(job.original_images)
+        return item["remaining"]
+
+    def take(self, batch_size):
+        """Return `(mode, entries)`: up to `batch_size` of the oldest queued
+        faces sharing the mode of the oldest one."""
+        mode = self.faces[0][1]["mode"]
+        batch = []
+        skipped = collections.deque()
+        while self.faces and len(batch) < batch_size:
+            entry = self.faces.popleft()
+            if entry[1]["mode"] == mode:
+                batch.append(entry)
+            else:
+                skipped.append(entry)
+        skipped.extend(self.faces)
+        self.faces = skipped
+        return mode, batch
+
+    def drain(self):
+        """Drop every queued face; returns the items they belonged to."""
+        items = []
+        seen = set()
+        for item, _, _ in self.faces:
+            if id(item) not in seen:
+                seen.add(id(item))
+                items.append(item)
+        self.faces.clear()
+        return items
+
+    @staticmethod
+    def faces_of(batch):
+        faces = np.array([group["job"].original_images[i] for _, group, i in batch])
+        targets = np.array([group["job"].target_embedding[i] for _, group, i in batch])
+        return faces, targets
+
+    def finish(self, batch, protected=None, iterations=None):
+        """Scatter the cloaks of `batch` back and return the items it
+        completed. Without `protected` the attack failed: the groups involved
+        are dropped and their images keep the original."""
+        done = []
+        for n, (item, group, i) in enumerate(batch):
+            if protected is None:
+                group["protected"] = None
+            elif group["protected"] is not None:
+                group["protected"][i] = protected[n]
+                group["job"].iterations[i] = iterations[n]
+            item["remaining"] -= 1
+            if item["remaining"] == 0:
+                done.append(item)
+        return done
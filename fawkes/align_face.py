@@ -1,5 +1,6 @@
 import numpy as np
 from fawkes import create_mtcnn, run_detect_face
+from fawkes.detect_faces import mtcnn_functions
 
 np_load_old = np.load
 np.load = lambda *a, **k: np_load_old(*a, allow_pickle=True, **k)
@@ -12,8 +13,12 @@ def to_rgb(img):
     return ret
 
 
-def aligner(sess):
-    pnet, rnet, onet = create_mtcnn(sess, None)
+def aligner(sess, dnet_weights=None, frozen=False):
+    # frozen: the MTCNN graph was imported from a compiled artifact
+    if frozen:
+        pnet, rnet, onet = mtcnn_functions(sess)
+    else:
+        pnet, rnet, onet = create_mtcnn(sess, None, dnet_weights=dnet_weights)
     return [pnet, rnet, onet]
 
 
@@ -0,0 +1,144 @@
+"""Compile the detector, feature extractors and attack graphs into one frozen
+artifact so new workers skip keras.models.load_model, the MTCNN pickle and
+the attack graph construction at startup.
+
+    python fawkes/artifacts.py --output ~/.fawkes/compiled --batch-sizes 1,2,4 --modes low,mid
+
+then pass the directory as `Fawkes(..., artifact=...)` (or `--artifact` to
+prod_worker). Extractor and MTCNN weights are frozen into constants; only
+the attack variables (modifier, images, optimizer slots) stay variables.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from fawkes.detect_faces import MTCNN_OUTPUTS
+
+GRAPH_FILE = "graph.pb"
+MANIFEST_FILE = "manifest.json"
+# bumped whenever the attack graphs compute something different, so a
+# worker refuses artifacts compiled from older code; 2: per-face targets,
+# best_adv reset in setup and the end-of-batch harvest
+ARTIFACT_FORMAT = 2
+
+
+class FrozenExtractor(object):
+    """predict()-compatible stand-in for a keras extractor whose graph was
+    imported from an artifact."""
+
+    def __init__(self, sess, input_name, output_name):
+        self.sess = sess
+        self.input = sess.graph.get_tensor_by_name(input_name)
+        self.output = sess.graph.get_tensor_by_name(output_name)
+
+    def predict(self, X, batch_size=32):
+        outputs = [self.sess.run(self.output, feed_dict={self.input: X[i:i + batch_size]})
+                   for i in range(0, len(X), batch_size)]
+        return np.concatenate(outputs)
+
+
+def _handle_names(names):
+    for name in names.values():
+        if isinstance(name, list):
+            for n in name:
+                yield n
+        else:
+            yield name
+
+
+def compile_artifact(protector, output_dir):
+    """Freeze everything a built Fawkes instance serves with into output_dir."""
+    sess = protector.sess
+    output_nodes = list(MTCNN_OUTPUTS)
+    keep_variables = []
+    manifest = {"format": ARTIFACT_FORMAT,
+                "feature_extractors": protector.fs_names,
+                "extractors": [],
+                "protectors": [],
+                "protector_kwargs": protector.protector_kwargs}
+
+    for model in protector.feature_extractors_ls:
+        manifest["extractors"].append({"input": model.input.name, "output": model.output.name})
+        output_nodes.append(model.output.op.name)
+
+    for key, attack in protector.protectors.items():
+        names = attack.manifest()
+        manifest["protectors"].append({"params": protector.protector_params[key], "handles": names})
+        output_nodes.extend(name.split(':')[0] for name in _handle_names(names))
+        keep_variables.extend(v.op.name for v in attack.own_variables)
+
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), output_nodes, variable_names_blacklist=keep_variables)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, GRAPH_FILE), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_artifact(sess, artifact_dir):
+    """Import a compiled graph into the session's graph and return its manifest."""
+    with open(os.path.join(artifact_dir, MANIFEST_FILE), 'r') as f:
+        manifest = json.load(f)
+    graph_def = tf.GraphDef()
+    with open(os.path.join(artifact_dir, GRAPH_FILE), 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    with sess.graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    return manifest
+
+
+def main(*argv):
+    if not argv:
+        argv = list(sys.argv)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', '-o', type=str, required=True,
+                        help="directory to write the compiled artifact to")
+    parser.add_argument('--feature-extractor', type=str, default="high_extract")
+    parser.add_argument('--gpu', '-g', type=str, default='0')
+    parser.add_argument('--batch-sizes', type=str, default="1",
+                        help="comma separated attack batch sizes to compile")
+    parser.add_argument('--modes', type=str, default="low",
+                        help="comma separated protection modes to compile for every batch size")
+    parser.add_argument('--steps-per-run', type=int, default=1,
+                        help="also compile the fused loop running this many attack steps per session call")
+    parser.add_argument('--plateau-window', type=int, default=0,
+                        help="early stopping criteria are baked into the graphs, pass the worker's values")
+    parser.add_argument('--target-bottlesim', type=float, default=0.0)
+    parser.add_argument('--stop-at-budget', action='store_true')
+    parser.add_argument('--optimizer', type=str, choices=['adadelta', 'adam', 'sign'], default='adadelta')
+    parser.add_argument('--optimizer-lr', type=float, default=None)
+    parser.add_argument('--refill', action='store_true',
+                        help="compile the slot refill ops used by the worker's --refill")
+    args = parser.parse_args(argv[1:])
+
+    from protection_compute_frontloaded import Fawkes
+
+    start = time.perf_counter()
+    modes = args.modes.split(',')
+    early_stopping = dict(plateau_window=args.plateau_window, target_bottlesim=args.target_bottlesim,
+                          stop_at_budget=args.stop_at_budget)
+    protector = Fawkes(args.feature_extractor, args.gpu, 1, modes=modes, steps_per_run=args.steps_per_run,
+                       early_stopping=early_stopping, refill=args.refill, optimizer=args.optimizer,
+                       optimizer_lr=args.optimizer_lr)
+    for batch_size in args.batch_sizes.split(','):
+        for mode in modes:
+            protector.get_protector(int(batch_size), mode=mode)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compile_artifact(protector, args.output)
+    print("built in {:.2f}s, compiled to {} in {:.2f}s".format(build_time, args.output,
+                                                              time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,103 @@
+import collections
+import time
+
+import numpy as np
+
+
+class SlotScheduler(object):
+    """Continuous batching for a FawkesMaskGeneration built with `refill`.
+
+    The attack graph has a fixed batch dimension; instead of running it on
+    consecutive slices until the slowest image of each slice is done, every
+    slot of the batch is handed the next queued image as soon as its own
+    image stops, early or at MAX_ITERATIONS. Each slot keeps its own step
+    count, learning rate schedule, optimizer state, target and best result,
+    so an image is optimized as it would be in a batch of its own.
+    """
+
+    def __init__(self, protector):
+        self.protector = protector
+
+    def _load(self, slots, faces, simg_tanh, timg_tanh):
+        p = self.protector
+        feed = {p.slot_holder: slots}
+        p.sess.run(p.load_slots, dict(feed, **{p.refill_simg_tanh: simg_tanh[faces],
+                                               p.refill_timg_tanh: timg_tanh[faces]}))
+        # target features and the floor read the images loaded above
+        p.sess.run(p.refill_bottleneck, feed)
+        if p.limit_dist:
+            p.sess.run(p.refill_floor, feed)
+
+    def attack(self, source_imgs, target_imgs):
+        p = self.protector
+        nb_imgs = len(source_imgs)
+        simg_tanh = p.preprocess_arctanh(np.array(source_imgs))
+        if p.MIMIC_IMG:
+            timg_tanh = p.preprocess_arctanh(np.array(target_imgs))
+        else:
+            timg_tanh = np.array(target_imgs)
+
+        # start with every slot empty and masked off
+        p.sess.run(p.init)
+        feed = {p.assign_simg_tanh: np.zeros(p.input_shape),
+                p.assign_const: np.ones(p.batch_size) * p.initial_const,
+                p.assign_mask: np.zeros(p.batch_size, dtype=np.bool),
+                p.assign_weights: np.zeros(p.bottleneck_shape),
+                p.assign_modifier: np.ones(p.input_shape) * 1e-6}
+        if p.MIMIC_IMG:
+            feed[p.assign_timg_tanh] = np.zeros(p.input_shape)
+        else:
+            feed[p.assign_bottleneck_t_raw] = np.zeros(p.bottleneck_shape)
+        p.sess.run(p.setup, feed)
+
+        queue = collections.deque(range(nb_imgs))
+        # face running in each slot, and the steps it ran
+        running = [None] * p.batch_size
+        steps = np.zeros(p.batch_size, dtype=np.int64)
+        adv_imgs = [None] * nb_imgs
+        iterations = [0] * nb_imgs
+
+        def refill(slots):
+            slots = slots[:len(queue)]
+            if not slots:
+                return
+            faces = [queue.popleft() for _ in slots]
+            self._load(slots, faces, simg_tanh, timg_tanh)
+            for slot, face in zip(slots, faces):
+                running[slot] = face
+                steps[slot] = 0
+
+        refill(list(range(p.batch_size)))
+        feed = {p.learning_rate_holder: p.learning_rate,
+                p.decay_every_holder: max(p.MAX_ITERATIONS // 3, 1)}
+        total_steps = 0
+        loop_start = time.time()
+        while any(face is not None for face in running):
+            _, active = p.sess.run([p.train, p.active], feed_dict=feed)
+            total_steps += 1
+            finished = []
+            for slot, face in enumerate(running):
+                if face is None:
+                    continue
+                steps[slot] += 1
+                if not active[slot] or steps[slot] >= p.MAX_ITERATIONS:
+                    finished.append(slot)
+            if not finished:
+                continue
+
+            best_adv, slot_iterations = p.sess.run([p.slot_best_adv, p.slot_iterations],
+                                                   {p.slot_holder: finished})
+            for slot, adv, n in zip(finished, best_adv, slot_iterations):
+                adv_imgs[running[slot]] = adv
+                iterations[running[slot]] = int(n)
+                running[slot] = None
+            refill(finished)
+            idle = [slot for slot in finished if running[slot] is None]
+            if idle:
+                p.sess.run(p.retire, {p.slot_holder: idle})
+
+        p.last_step_time = (time.time() - loop_start) / max(total_steps, 1)
+        # steps per batch_size images, what a fixed batch would have cost
+        p.last_steps = int(np.ceil(total_steps / max(np.ceil(nb_imgs / float(p.batch_size)), 1)))
+        p.last_iterations = iterations
+        return p.clipping(np.array(adv_imgs))
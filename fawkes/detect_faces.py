@@ -255,13 +255,20 @@ class ONet(Network):
          .fc(10, relu=False, name='conv6-3'))
 
 
-def create_mtcnn(sess, model_path):
+def load_mtcnn_weights():
     model_dir = os.path.join(os.path.expanduser('~'), '.fawkes')
     os.makedirs(model_dir, exist_ok=True)
 
     fp = gzip.open(os.path.join(model_dir, "mtcnn.p.gz"), 'rb')
     dnet_weights = pickle.load(fp)
     fp.close()
+    return dnet_weights
+
+
+def create_mtcnn(sess, model_path, dnet_weights=None):
+    # dnet_weights can be preloaded once (e.g. before forking workers)
+    if dnet_weights is None:
+        dnet_weights = load_mtcnn_weights()
 
     with tf.variable_scope('pnet'):
         data = tf.placeholder(tf.float32, (None, None, None, 3), 'input')
@@ -278,6 +285,17 @@ def create_mtcnn(sess, model_path):
         onet = ONet({'data': data})
         onet.load(dnet_weights[2], sess)
 
+    return mtcnn_functions(sess)
+
+
+# graph outputs the detector runs, also kept when the graph is frozen
+MTCNN_OUTPUTS = ['pnet/conv4-2/BiasAdd', 'pnet/prob1', 'rnet/conv5-2/conv5-2', 'rnet/prob1',
+                 'onet/conv6-2/conv6-2', 'onet/conv6-3/conv6-3', 'onet/prob1']
+
+
+def mtcnn_functions(sess):
+    """Detector callables over the pnet/rnet/onet tensors already in the
+    session's graph, whether built by create_mtcnn or imported frozen."""
     pnet_fun = lambda img: sess.run(('pnet/conv4-2/BiasAdd:0', 'pnet/prob1:0'), feed_dict={'pnet/input:0': img})
     rnet_fun = lambda img: sess.run(('rnet/conv5-2/conv5-2:0', 'rnet/prob1:0'), feed_dict={'rnet/input:0': img})
     onet_fun = lambda img: sess.run(('onet/conv6-2/conv6-2:0', 'onet/conv6-3/conv6-3:0', 'onet/prob1:0'),
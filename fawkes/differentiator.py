@@ -9,6 +9,8 @@ from decimal import Decimal
 
 import numpy as np
 import tensorflow as tf
+from fawkes.attack_scheduler import SlotScheduler
+from fawkes.optimizers import make_optimizer
 from fawkes.utils import preprocess, reverse_preprocess
 from keras.utils import Progbar
 
@@ -41,13 +43,45 @@ class FawkesMaskGeneration:
     IMAGE_SHAPE = (224, 224, 3)
     RATIO = 1.0
     LIMIT_DIST = False
+    # relative bottlesim improvement that resets the plateau window
+    PLATEAU_TOL = 1e-3
+    # no image stops early before this many steps
+    MIN_STEPS = 20
+    # graph handles attack()/attack_batch() need; manifest() records their
+    # names so a compiled graph can be reattached without rebuilding it
+    GRAPH_HANDLES = ('init', 'setup', 'setup_bottleneck', 'train', 'learning_rate_holder',
+                     'assign_modifier', 'assign_timg_tanh', 'assign_bottleneck_t_raw', 'assign_simg_tanh',
+                     'assign_const', 'assign_mask', 'assign_weights',
+                     'loss_sum', 'dist_sum', 'dist_raw_sum', 'bottlesim_sum',
+                     'dist_raw', 'bottlesim', 'aimg_input',
+                     'update_best', 'best_adv', 'assign_bottlesim_floor', 'set_bottlesim_floor',
+                     'fused_train', 'fused_steps', 'decay_every_holder', 'any_active', 'iterations', 'active',
+                     'slot_holder', 'refill_simg_tanh', 'refill_timg_tanh', 'load_slots', 'refill_bottleneck',
+                     'refill_floor', 'retire', 'slot_best_adv', 'slot_iterations', 'harvest_mask', 'harvest')
 
     def __init__(self, sess, bottleneck_model_ls, mimic_img=MIMIC_IMG,
                  batch_size=1, learning_rate=LEARNING_RATE,
                  max_iterations=MAX_ITERATIONS, initial_const=INITIAL_CONST,
                  intensity_range=INTENSITY_RANGE, l_threshold=L_THRESHOLD,
                  max_val=MAX_VAL, keep_final=KEEP_FINAL, maximize=MAXIMIZE, image_shape=IMAGE_SHAPE,
-                 verbose=0, ratio=RATIO, limit_dist=LIMIT_DIST):
+                 verbose=0, ratio=RATIO, limit_dist=LIMIT_DIST, steps_per_run=1, plateau_window=0,
+                 plateau_tol=PLATEAU_TOL, target_bottlesim=0.0, stop_at_budget=False, min_steps=MIN_STEPS,
+                 refill=False, optimizer='adadelta', manifest=None):
+        """With `manifest` (see manifest()), attach to an already imported
+        graph instead of building one; `bottleneck_model_ls` is then unused.
+        With `steps_per_run` > 1, attack_batch runs that many optimization
+        steps per session call in an in-graph loop.
+
+        An image stops early, once it ran `min_steps`, when its best
+        bottlesim has not improved by `plateau_tol` in `plateau_window` steps,
+        reached `target_bottlesim`, or (`stop_at_budget`) its DSSIM reached
+        `l_threshold`; a batch ends when all of its images have stopped. The
+        criteria are off by default.
+
+        `optimizer` names one of fawkes.optimizers.OPTIMIZERS.
+
+        With `refill`, attack() hands a finished image's slot to the next
+        queued one (see SlotScheduler) instead of running fixed batches."""
 
         assert intensity_range in {'raw', 'imagenet', 'inception', 'mnist'}
 
@@ -69,6 +103,21 @@ class FawkesMaskGeneration:
         self.ratio = ratio
         self.limit_dist = limit_dist
         self.single_shape = list(image_shape)
+        self.last_step_time = None
+        self.last_steps = None
+        self.steps_per_run = steps_per_run
+        self.plateau_window = plateau_window
+        self.plateau_tol = plateau_tol
+        self.target_bottlesim = target_bottlesim
+        self.stop_at_budget = stop_at_budget
+        self.min_steps = min_steps
+        self.last_iterations = []
+        self.fused_train = None
+        self.any_active = None
+        self.iterations = None
+        self.refill = refill
+        self.optimizer = optimizer
+        self.slot_holder = None
 
         self.input_shape = tuple([self.batch_size] + self.single_shape)
 
@@ -76,6 +125,14 @@ class FawkesMaskGeneration:
 
         # self.bottleneck_shape = tuple([self.batch_size, bottleneck_model_ls[0].output_shape[-1]])
 
+        if manifest is not None:
+            self.attach(sess.graph, manifest)
+        else:
+            self.build(bottleneck_model_ls)
+
+    def build(self, bottleneck_model_ls):
+        before_vars = set(x.name for x in tf.global_variables())
+
         # the variable we're going to optimize over
         self.modifier = tf.Variable(np.zeros(self.input_shape, dtype=np.float32))
 
@@ -87,8 +144,8 @@ class FawkesMaskGeneration:
         # source image in tanh space
         self.simg_tanh = tf.Variable(np.zeros(self.input_shape), dtype=np.float32)
 
-        self.const = tf.Variable(np.ones(batch_size), dtype=np.float32)
-        self.mask = tf.Variable(np.ones((batch_size), dtype=np.bool))
+        self.const = tf.Variable(np.ones(self.batch_size), dtype=np.float32)
+        self.mask = tf.Variable(np.ones((self.batch_size), dtype=np.bool))
         self.weights = tf.Variable(np.ones(self.bottleneck_shape,
                                            dtype=np.float32))
 
@@ -101,15 +158,10 @@ class FawkesMaskGeneration:
             self.assign_bottleneck_t_raw = tf.placeholder(
                 tf.float32, self.bottleneck_shape)
         self.assign_simg_tanh = tf.placeholder(tf.float32, self.input_shape)
-        self.assign_const = tf.placeholder(tf.float32, (batch_size))
-        self.assign_mask = tf.placeholder(tf.bool, (batch_size))
+        self.assign_const = tf.placeholder(tf.float32, (self.batch_size))
+        self.assign_mask = tf.placeholder(tf.bool, (self.batch_size))
         self.assign_weights = tf.placeholder(tf.float32, self.bottleneck_shape)
 
-        # the resulting image, tanh'd to keep bounded from -0.5 to 0.5
-        # adversarial image in raw space
-        self.aimg_raw = (tf.tanh(self.modifier + self.simg_tanh) /
-                         self.tanh_constant +
-                         0.5) * 255.0
         # source image in raw space
         self.simg_raw = (tf.tanh(self.simg_tanh) /
                          self.tanh_constant +
@@ -122,19 +174,133 @@ class FawkesMaskGeneration:
 
         # convert source and adversarial image into input space
         if self.intensity_range == 'imagenet':
-            mean = tf.constant(np.repeat([[[[103.939, 116.779, 123.68]]]], self.batch_size, axis=0), dtype=tf.float32,
-                               name='img_mean')
-            self.aimg_input = (self.aimg_raw[..., ::-1] - mean)
-            self.simg_input = (self.simg_raw[..., ::-1] - mean)
+            self.img_mean = tf.constant(np.repeat([[[[103.939, 116.779, 123.68]]]], self.batch_size, axis=0),
+                                        dtype=tf.float32, name='img_mean')
+            self.simg_input = (self.simg_raw[..., ::-1] - self.img_mean)
             if self.MIMIC_IMG:
-                self.timg_input = (self.timg_raw[..., ::-1] - mean)
+                self.timg_input = (self.timg_raw[..., ::-1] - self.img_mean)
 
         elif self.intensity_range == 'raw':
-            self.aimg_input = self.aimg_raw
             self.simg_input = self.simg_raw
             if self.MIMIC_IMG:
                 self.timg_input = self.timg_raw
 
+        def calculate_direction(bottleneck_model, cur_timg_input, cur_simg_input):
+            # per image, so faces of other users, padding and empty slots
+            # in the same batch do not move each other's target
+            target_features = bottleneck_model(cur_timg_input)
+            original = bottleneck_model(cur_simg_input)
+            direction = target_features - original
+            final_target = original + 2.0 * direction
+            return final_target
+
+        # the target features only depend on the source and target images,
+        # which are fixed for a batch: compute them once per batch into a
+        # variable instead of two extra forward passes on every step
+        self.bottleneck_model_ls = bottleneck_model_ls
+        self.bottleneck_targets = []
+        self.bottleneck_final = []
+        self.setup_bottleneck = []
+        for bottleneck_model in bottleneck_model_ls:
+            if self.MIMIC_IMG:
+                final_target = calculate_direction(bottleneck_model, self.timg_input, self.simg_input)
+                bottleneck_t = tf.Variable(np.zeros(final_target.shape.as_list(), dtype=np.float32),
+                                           trainable=False)
+                self.setup_bottleneck.append(bottleneck_t.assign(final_target))
+                self.bottleneck_final.append(final_target)
+            else:
+                bottleneck_t = self.bottleneck_t_raw
+            self.bottleneck_targets.append(bottleneck_t)
+
+        forward = self.forward(self.modifier, self.mask)
+        for name, tensor in forward.items():
+            setattr(self, name, tensor)
+
+        # best result so far, tracked on the device so the host only fetches
+        # best_adv once per batch
+        worst = 0.0 if self.maximize else np.inf
+        self.best_bottlesim = tf.Variable(np.full(self.batch_size, worst, dtype=np.float32), trainable=False)
+        self.best_adv = tf.Variable(np.zeros(self.input_shape, dtype=np.float32), trainable=False)
+        # with limit_dist, results closer than this to the target are ignored
+        self.bottlesim_floor = tf.Variable(np.zeros(self.batch_size, dtype=np.float32), trainable=False)
+        # steps each image was optimized for, and since it last improved
+        self.iterations = tf.Variable(np.zeros(self.batch_size, dtype=np.int64), trainable=False)
+        self.since_improved = tf.Variable(np.zeros(self.batch_size, dtype=np.int64), trainable=False)
+        self.assign_bottlesim_floor = tf.placeholder(tf.float32, (self.batch_size))
+        self.set_bottlesim_floor = self.bottlesim_floor.assign(self.assign_bottlesim_floor)
+
+        start_vars = set(x.name for x in tf.global_variables())
+        self.learning_rate_holder = tf.placeholder(tf.float32, shape=[])
+        self.decay_every_holder = tf.placeholder(tf.int64, shape=[])
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+        # the learning rate is read when a training op is built, so the fused
+        # loop below can hand the optimizer its in-graph schedule
+        self._learning_rate = self.learning_rate_holder
+        optimizer = make_optimizer(self.optimizer, lambda: self._learning_rate)
+
+        # the forward pass that feeds the gradients also decides whether the
+        # image produced by the previous step is the best so far, before this
+        # step moves the modifier; the initial image (step 0) never counts
+        grads_and_vars = optimizer.compute_gradients(self.loss_sum, var_list=[self.modifier])
+        self.update_best, improved = self.best_update(forward, self.iterations, self.mask, self.best_bottlesim,
+                                                      self.best_adv)
+        with tf.control_dependencies([self.update_best]):
+            apply = self.apply_step(optimizer, grads_and_vars)
+        # then retire the images that are done from the mask
+        with tf.control_dependencies([apply]):
+            self.train, self.any_active, self.active = self.stop_update(forward, improved)
+        # when a batch ends the last step of every image has not been
+        # compared yet, including the images stop_update already retired
+        # from the mask; the caller passes the images of the batch
+        self.harvest_mask = tf.placeholder(tf.bool, (self.batch_size))
+        self.harvest, _ = self.best_update(forward, self.iterations, self.harvest_mask, self.best_bottlesim,
+                                           self.best_adv)
+
+        if self.steps_per_run > 1:
+            self.build_fused(optimizer)
+        if self.refill:
+            self.build_refill(optimizer, forward, worst)
+        end_vars = tf.global_variables()
+        new_vars = [x for x in end_vars if x.name not in start_vars]
+
+        # these are the variables to initialize when we run
+        self.setup = []
+        self.setup.append(self.modifier.assign(self.assign_modifier))
+        if self.MIMIC_IMG:
+            self.setup.append(self.timg_tanh.assign(self.assign_timg_tanh))
+        else:
+            self.setup.append(self.bottleneck_t_raw.assign(
+                self.assign_bottleneck_t_raw))
+        self.setup.append(self.simg_tanh.assign(self.assign_simg_tanh))
+        self.setup.append(self.const.assign(self.assign_const))
+        self.setup.append(self.mask.assign(self.assign_mask))
+        self.setup.append(self.weights.assign(self.assign_weights))
+        self.setup.append(self.best_bottlesim.assign(tf.fill([self.batch_size], worst)))
+        self.setup.append(self.best_adv.assign(tf.zeros(self.input_shape)))
+        self.setup.append(self.bottlesim_floor.assign(tf.zeros([self.batch_size])))
+        self.setup.append(self.iterations.assign(tf.zeros([self.batch_size], dtype=tf.int64)))
+        self.setup.append(self.since_improved.assign(tf.zeros([self.batch_size], dtype=tf.int64)))
+
+        self.init = tf.variables_initializer(var_list=[self.modifier] + new_vars)
+
+        # every variable owned by this attack (including optimizer slots),
+        # these must stay variables when the rest of the graph is frozen
+        self.own_variables = [x for x in tf.global_variables() if x.name not in before_vars]
+
+    def forward(self, modifier, mask):
+        """Adversarial image, distances and loss for `modifier`; built once
+        for the per-step train op and again inside the fused loop."""
+        # the resulting image, tanh'd to keep bounded from -0.5 to 0.5
+        # adversarial image in raw space
+        aimg_raw = (tf.tanh(modifier + self.simg_tanh) /
+                    self.tanh_constant +
+                    0.5) * 255.0
+        if self.intensity_range == 'imagenet':
+            aimg_input = (aimg_raw[..., ::-1] - self.img_mean)
+        else:
+            aimg_input = aimg_raw
+
         def batch_gen_DSSIM(aimg_raw_split, simg_raw_split):
             msssim_split = tf.image.ssim(aimg_raw_split, simg_raw_split, max_val=255.0)
             dist = (1.0 - tf.stack(msssim_split)) / 2.0
@@ -142,15 +308,15 @@ class FawkesMaskGeneration:
             return dist
 
         # raw value of DSSIM distance
-        self.dist_raw = batch_gen_DSSIM(self.aimg_raw, self.simg_raw)
+        dist_raw = batch_gen_DSSIM(aimg_raw, self.simg_raw)
         # distance value after applying threshold
-        self.dist = tf.maximum(self.dist_raw - self.l_threshold, 0.0)
+        dist = tf.maximum(dist_raw - self.l_threshold, 0.0)
         # self.dist = self.dist_raw
-        self.dist_raw_sum = tf.reduce_sum(
-            tf.where(self.mask,
-                     self.dist_raw,
-                     tf.zeros_like(self.dist_raw)))
-        self.dist_sum = tf.reduce_sum(tf.where(self.mask, self.dist, tf.zeros_like(self.dist)))
+        dist_raw_sum = tf.reduce_sum(
+            tf.where(mask,
+                     dist_raw,
+                     tf.zeros_like(dist_raw)))
+        dist_sum = tf.reduce_sum(tf.where(mask, dist, tf.zeros_like(dist)))
 
         def resize_tensor(input_tensor, model_input_shape):
             if input_tensor.shape[1:] == model_input_shape or model_input_shape[1] is None:
@@ -158,78 +324,216 @@ class FawkesMaskGeneration:
             resized_tensor = tf.image.resize(input_tensor, model_input_shape[:2])
             return resized_tensor
 
-        def calculate_direction(bottleneck_model, cur_timg_input, cur_simg_input):
-            target_features = bottleneck_model(cur_timg_input)
-            #return target_features
-            target_center = tf.reduce_mean(target_features, axis=0)
-            original = bottleneck_model(cur_simg_input)
-            original_center = tf.reduce_mean(original, axis=0)
-            direction = target_center - original_center
-            final_target = original + 2.0 * direction
-            return final_target
-
-        self.bottlesim = 0.0
-        self.bottlesim_sum = 0.0
-        self.bottlesim_push = 0.0
-        for bottleneck_model in bottleneck_model_ls:
+        bottlesim = 0.0
+        bottlesim_sum = 0.0
+        for bottleneck_model, bottleneck_t in zip(self.bottleneck_model_ls, self.bottleneck_targets):
             model_input_shape = (224, 224, 3)
 
-            cur_aimg_input = resize_tensor(self.aimg_input, model_input_shape)
+            cur_aimg_input = resize_tensor(aimg_input, model_input_shape)
 
-            self.bottleneck_a = bottleneck_model(cur_aimg_input)
-            if self.MIMIC_IMG:
-                cur_timg_input = self.timg_input
-                cur_simg_input = self.simg_input
-                self.bottleneck_t = calculate_direction(bottleneck_model, cur_timg_input, cur_simg_input)
-            else:
-                self.bottleneck_t = self.bottleneck_t_raw
+            bottleneck_a = bottleneck_model(cur_aimg_input)
 
-            bottleneck_diff = self.bottleneck_t - self.bottleneck_a
+            bottleneck_diff = bottleneck_t - bottleneck_a
 
-            scale_factor = tf.sqrt(tf.reduce_sum(tf.square(self.bottleneck_t), axis=1))
+            scale_factor = tf.sqrt(tf.reduce_sum(tf.square(bottleneck_t), axis=1))
 
             cur_bottlesim = tf.sqrt(tf.reduce_sum(tf.square(bottleneck_diff), axis=1))
             cur_bottlesim = cur_bottlesim / scale_factor
             cur_bottlesim_sum = tf.reduce_sum(cur_bottlesim)
 
-            self.bottlesim += cur_bottlesim
+            bottlesim += cur_bottlesim
 
-            self.bottlesim_sum += cur_bottlesim_sum
+            bottlesim_sum += cur_bottlesim_sum
 
         # sum up the losses
         if self.maximize:
-            self.loss = self.const * tf.square(self.dist) - self.bottlesim
+            loss = self.const * tf.square(dist) - bottlesim
         else:
-            self.loss = self.const * tf.square(self.dist) + self.bottlesim
-
-        self.loss_sum = tf.reduce_sum(tf.where(self.mask,
-                                               self.loss,
-                                               tf.zeros_like(self.loss)))
-
-        start_vars = set(x.name for x in tf.global_variables())
-        self.learning_rate_holder = tf.placeholder(tf.float32, shape=[])
-
-        optimizer = tf.train.AdadeltaOptimizer(self.learning_rate_holder)
-        # optimizer = tf.train.AdamOptimizer(self.learning_rate_holder)
-
-        self.train = optimizer.minimize(self.loss_sum, var_list=[self.modifier])
-        end_vars = tf.global_variables()
-        new_vars = [x for x in end_vars if x.name not in start_vars]
-
-        # these are the variables to initialize when we run
-        self.setup = []
-        self.setup.append(self.modifier.assign(self.assign_modifier))
-        if self.MIMIC_IMG:
-            self.setup.append(self.timg_tanh.assign(self.assign_timg_tanh))
+            loss = self.const * tf.square(dist) + bottlesim
+
+        loss_sum = tf.reduce_sum(tf.where(mask,
+                                          loss,
+                                          tf.zeros_like(loss)))
+        return dict(aimg_raw=aimg_raw, aimg_input=aimg_input, dist_raw=dist_raw, dist=dist,
+                    dist_raw_sum=dist_raw_sum, dist_sum=dist_sum, bottlesim=bottlesim,
+                    bottlesim_sum=bottlesim_sum, loss=loss, loss_sum=loss_sum)
+
+    def best_update(self, forward, iterations, mask, best_bottlesim, best_adv):
+        """Returns the op keeping the best result and, per image, whether it
+        improved by more than `plateau_tol` (relative). An image that has not
+        been stepped yet (`iterations` 0) never counts."""
+        bottlesim = forward["bottlesim"]
+        if self.maximize:
+            improved = bottlesim > best_bottlesim
+            significant = bottlesim > best_bottlesim * (1.0 + self.plateau_tol)
         else:
-            self.setup.append(self.bottleneck_t_raw.assign(
-                self.assign_bottleneck_t_raw))
-        self.setup.append(self.simg_tanh.assign(self.assign_simg_tanh))
-        self.setup.append(self.const.assign(self.assign_const))
-        self.setup.append(self.mask.assign(self.assign_mask))
-        self.setup.append(self.weights.assign(self.assign_weights))
-
-        self.init = tf.variables_initializer(var_list=[self.modifier] + new_vars)
+            improved = tf.logical_and(bottlesim < best_bottlesim, bottlesim > self.bottlesim_floor)
+            significant = bottlesim < best_bottlesim * (1.0 - self.plateau_tol)
+        improved = tf.logical_and(tf.logical_and(improved, mask), iterations > 0)
+        update = tf.group(
+            self.best_bottlesim.assign(tf.where(improved, bottlesim, best_bottlesim)),
+            self.best_adv.assign(tf.where(improved, forward["aimg_input"], best_adv)))
+        return update, tf.logical_and(improved, significant)
+
+    def stop_update(self, forward, improved):
+        """Count the step for every active image and drop the ones that meet a
+        stopping criterion from `mask`. Masked images no longer contribute to
+        the loss, so their modifier stops moving. Must run after the step's
+        update; returns the op, whether any image is still active and the
+        new mask."""
+        mask = self.mask.read_value()
+        iterations = self.iterations.assign_add(tf.cast(mask, tf.int64))
+        since_improved = self.since_improved.assign(
+            tf.where(improved, tf.zeros_like(self.since_improved), self.since_improved + 1))
+
+        done = tf.zeros_like(mask)
+        if self.plateau_window:
+            done = tf.logical_or(done, since_improved >= self.plateau_window)
+        if self.target_bottlesim:
+            best_bottlesim = self.best_bottlesim.read_value()
+            if self.maximize:
+                done = tf.logical_or(done, best_bottlesim >= self.target_bottlesim)
+            else:
+                done = tf.logical_or(done, best_bottlesim <= self.target_bottlesim)
+        if self.stop_at_budget:
+            done = tf.logical_or(done, forward["dist_raw"] >= self.l_threshold)
+        done = tf.logical_and(done, iterations >= self.min_steps)
+
+        active = tf.logical_and(mask, tf.logical_not(done))
+        update = self.mask.assign(active)
+        with tf.control_dependencies([update]):
+            any_active = tf.reduce_any(active)
+        return update.op, any_active, active
+
+    def apply_step(self, optimizer, grads_and_vars):
+        """Apply the step. With `refill` the images of a batch started at
+        different steps, so the 0.8x decay every `decay_every_holder` steps is
+        applied per image, from its own step count, by scaling its update;
+        the fed learning rate is then the undecayed one."""
+        if not self.refill:
+            return optimizer.apply_gradients(grads_and_vars, global_step=self.step)
+        # a product, not a read, so the in-place update cannot alias it
+        before = self.modifier * 1.0
+        with tf.control_dependencies([before]):
+            apply = optimizer.apply_gradients(grads_and_vars, global_step=self.step)
+        with tf.control_dependencies([apply]):
+            after = self.modifier.read_value()
+            decays = tf.maximum(self.iterations - 1, 0) // self.decay_every_holder
+            scale = tf.reshape(tf.pow(0.8, tf.cast(decays, tf.float32)), [-1, 1, 1, 1])
+            return self.modifier.assign(before + (after - before) * scale).op
+
+    def build_fused(self, optimizer):
+        """`fused_train` runs `fused_steps` optimization steps in one session
+        call. The step learning rate follows the same schedule attack_batch
+        applies in Python, 0.8x every `decay_every_holder` steps, computed from
+        the step counter so consecutive calls continue where the last ended."""
+        self.fused_steps = tf.placeholder(tf.int64, shape=[])
+
+        def body(i, active):
+            # reading after the previous iteration's update is what makes
+            # every iteration see the modifier it left behind
+            with tf.control_dependencies([i, active]):
+                step = self.step.read_value()
+                modifier = self.modifier.read_value()
+                mask = self.mask.read_value()
+                iterations = self.iterations.read_value()
+                best_bottlesim = self.best_bottlesim.read_value()
+                best_adv = self.best_adv.read_value()
+            decays = tf.maximum(step - 1, 0) // self.decay_every_holder
+            self._learning_rate = self.learning_rate_holder * tf.pow(0.8, tf.cast(decays, tf.float32))
+
+            forward = self.forward(modifier, mask)
+            grad = tf.gradients(forward["loss_sum"], modifier)[0]
+            update_best, improved = self.best_update(forward, iterations, mask, best_bottlesim, best_adv)
+            with tf.control_dependencies([update_best]):
+                train = optimizer.apply_gradients([(grad, self.modifier)], global_step=self.step)
+            with tf.control_dependencies([train]):
+                _, any_active, _ = self.stop_update(forward, improved)
+                return i + 1, any_active
+
+        # stops early once every image is done
+        self.fused_train = tf.while_loop(lambda i, active: tf.logical_and(i < self.fused_steps, active), body,
+                                         [tf.constant(0, dtype=tf.int64), tf.constant(True)],
+                                         back_prop=False, parallel_iterations=1)
+        self._learning_rate = self.learning_rate_holder
+
+    def build_refill(self, optimizer, forward, worst):
+        """Per-slot ops for SlotScheduler, all indexed by `slot_holder`:
+        `load_slots` loads new images into the slots and resets everything the
+        attack keeps per image (modifier, optimizer slots, best result,
+        counters, mask), `refill_bottleneck` then computes their target
+        features and `refill_floor` their limit_dist floor. `retire` masks
+        slots off, `slot_best_adv` and `slot_iterations` fetch their results
+        after comparing their last step."""
+        self.slot_holder = tf.placeholder(tf.int32, [None])
+        self.refill_simg_tanh = tf.placeholder(tf.float32, [None] + list(self.input_shape[1:]))
+        self.refill_timg_tanh = tf.placeholder(tf.float32, [None] + list(self.bottleneck_shape[1:]))
+        nb_slots = tf.shape(self.slot_holder)[:1]
+
+        def scatter(var, values):
+            return tf.scatter_update(var, self.slot_holder, values)
+
+        def fill(var, value):
+            shape = tf.concat([nb_slots, tf.shape(var)[1:]], 0)
+            return scatter(var, tf.fill(shape, tf.constant(value, dtype=var.dtype.base_dtype)))
+
+        refill = [scatter(self.simg_tanh, self.refill_simg_tanh),
+                  scatter(self.timg_tanh if self.MIMIC_IMG else self.bottleneck_t_raw, self.refill_timg_tanh),
+                  fill(self.modifier, 1e-6),
+                  fill(self.const, float(self.initial_const)),
+                  fill(self.mask, True),
+                  fill(self.best_bottlesim, worst),
+                  fill(self.best_adv, 0.0),
+                  fill(self.bottlesim_floor, 0.0),
+                  fill(self.iterations, 0),
+                  fill(self.since_improved, 0)]
+        # per-variable slots only; Adam's bias correction powers stay shared
+        for name in optimizer.get_slot_names():
+            slot = optimizer.get_slot(self.modifier, name)
+            if slot is not None:
+                refill.append(fill(slot, 0.0))
+        self.load_slots = tf.group(*refill)
+
+        # same per-image target as setup_bottleneck, for the refilled slots
+        self.refill_bottleneck = tf.group(*[
+            scatter(bottleneck_t, tf.gather(final_target, self.slot_holder))
+            for bottleneck_t, final_target in zip(self.bottleneck_targets, self.bottleneck_final)])
+        self.refill_floor = scatter(self.bottlesim_floor, tf.gather(forward["bottlesim"], self.slot_holder) * 0.1)
+        self.retire = fill(self.mask, False).op
+
+        # a finished slot's last step has not been compared yet
+        slots_mask = tf.cast(tf.scatter_nd(tf.expand_dims(self.slot_holder, 1), tf.ones_like(self.slot_holder),
+                                           [self.batch_size]), tf.bool)
+        harvest, _ = self.best_update(forward, self.iterations, slots_mask, self.best_bottlesim, self.best_adv)
+        with tf.control_dependencies([harvest]):
+            self.slot_best_adv = tf.gather(self.best_adv.read_value(), self.slot_holder)
+            self.slot_iterations = tf.gather(self.iterations.read_value(), self.slot_holder)
+
+    def manifest(self):
+        names = {}
+        for attr in self.GRAPH_HANDLES:
+            handle = getattr(self, attr, None)
+            if handle is None:
+                continue
+            if isinstance(handle, list):
+                names[attr] = [h.name for h in handle]
+            else:
+                names[attr] = handle.name
+        return names
+
+    def attach(self, graph, manifest):
+        def lookup(name):
+            if ':' in name:
+                return graph.get_tensor_by_name(name)
+            return graph.get_operation_by_name(name)
+
+        self.setup_bottleneck = []
+        for attr, name in manifest.items():
+            if isinstance(name, list):
+                setattr(self, attr, [lookup(n) for n in name])
+            else:
+                setattr(self, attr, lookup(name))
+        self.own_variables = []
 
     def preprocess_arctanh(self, imgs):
 
@@ -267,7 +571,14 @@ class FawkesMaskGeneration:
 
         start_time = time.time()
 
+        if self.refill:
+            adv_imgs = SlotScheduler(self).attack(source_imgs, target_imgs)
+            print('protection cost %f s' % (time.time() - start_time))
+            print('iterations per image: %s' % self.last_iterations)
+            return adv_imgs
+
         adv_imgs = []
+        self.last_iterations = []
         print('%d batches in total'
               % int(np.ceil(len(source_imgs) / self.batch_size)))
 
@@ -280,9 +591,33 @@ class FawkesMaskGeneration:
 
         elapsed_time = time.time() - start_time
         print('protection cost %f s' % (elapsed_time))
+        if self.last_iterations:
+            print('iterations per image: %s' % self.last_iterations)
 
         return np.array(adv_imgs)
 
+    def run_fused(self, nb_imgs, progressbar=None):
+        """Run the whole schedule `steps_per_run` steps per session call;
+        returns the index of the last step like the per-step loop."""
+        feed = {self.learning_rate_holder: self.learning_rate,
+                self.decay_every_holder: max(self.MAX_ITERATIONS // 3, 1)}
+        done = 0
+        while done < self.MAX_ITERATIONS:
+            steps = min(self.steps_per_run, self.MAX_ITERATIONS - done)
+            feed[self.fused_steps] = steps
+            ran, active = self.sess.run(self.fused_train, feed_dict=feed)
+            done += int(ran)
+            if self.verbose == 1:
+                dist_raw_sum = float(self.sess.run(self.dist_raw_sum))
+                bottlesim_sum = self.sess.run(self.bottlesim_sum)
+                print('ITER %4d perturb: %.5f; sim: %f'
+                      % (done - 1, dist_raw_sum / nb_imgs, bottlesim_sum / nb_imgs))
+            elif progressbar is not None:
+                progressbar.update(done - 1)
+            if not active:
+                break
+        return done - 1
+
     def attack_batch(self, source_imgs, target_imgs, weights):
 
         """
@@ -339,9 +674,8 @@ class FawkesMaskGeneration:
                            self.assign_mask: mask,
                            self.assign_weights: weights_batch,
                            self.assign_modifier: modifier_batch})
-
-        best_bottlesim = [0] * nb_imgs if self.maximize else [np.inf] * nb_imgs
-        best_adv = np.zeros_like(source_imgs)
+        if self.setup_bottleneck:
+            self.sess.run(self.setup_bottleneck)
 
         if self.verbose == 1:
             loss_sum = float(self.sess.run(self.loss_sum))
@@ -356,71 +690,55 @@ class FawkesMaskGeneration:
                      dist_raw_sum,
                      bottlesim_sum / nb_imgs))
 
-        finished_idx = set()
-        total_distance = [0] * nb_imgs
-
         if self.limit_dist:
-            dist_raw_list, bottlesim_list, aimg_input_list = self.sess.run(
-                [self.dist_raw,
-                 self.bottlesim,
-                 self.aimg_input])
-            for e, (dist_raw, bottlesim, aimg_input) in enumerate(
-                    zip(dist_raw_list, bottlesim_list, aimg_input_list)):
-                if e >= nb_imgs:
-                    break
-                total_distance[e] = bottlesim
+            bottlesim_list = self.sess.run(self.bottlesim)
+            self.sess.run(self.set_bottlesim_floor, {self.assign_bottlesim_floor: bottlesim_list * 0.1})
 
         if self.verbose == 0:
             progressbar = Progbar(
                 self.MAX_ITERATIONS, width=30, verbose=1
             )
 
-        for iteration in range(self.MAX_ITERATIONS):
-
-            self.sess.run([self.train], feed_dict={self.learning_rate_holder: LR})
-
-            dist_raw_list, bottlesim_list, aimg_input_list = self.sess.run(
-                [self.dist_raw,
-                 self.bottlesim,
-                 self.aimg_input])
-
-            all_clear = True
-            for e, (dist_raw, bottlesim, aimg_input) in enumerate(
-                    zip(dist_raw_list, bottlesim_list, aimg_input_list)):
-
-                if e in finished_idx:
-                    continue
+        feed_dict = {self.learning_rate_holder: LR}
+        if self.refill:
+            # decayed per image inside the graph
+            feed_dict[self.decay_every_holder] = max(self.MAX_ITERATIONS // 3, 1)
 
-                if e >= nb_imgs:
-                    break
-                if (bottlesim < best_bottlesim[e] and bottlesim > total_distance[e] * 0.1 and (
-                        not self.maximize)) or (
-                        bottlesim > best_bottlesim[e] and self.maximize):
-                    best_bottlesim[e] = bottlesim
-                    best_adv[e] = aimg_input
-
-                # if iteration > 20 and (dist_raw >= self.l_threshold or iteration == self.MAX_ITERATIONS - 1):
-                #     finished_idx.add(e)
-                #     print("{} finished at dist {}".format(e, dist_raw))
-                #     best_bottlesim[e] = bottlesim
-                #     best_adv[e] = aimg_input
-                #
-                all_clear = False
-
-            if all_clear:
-                break
-
-            if iteration != 0 and iteration % (self.MAX_ITERATIONS // 3) == 0:
-                LR = LR * 0.8
-
-            if iteration % (self.MAX_ITERATIONS // 5) == 0:
-                if self.verbose == 1:
-                    dist_raw_sum = float(self.sess.run(self.dist_raw_sum))
-                    bottlesim_sum = self.sess.run(self.bottlesim_sum)
-                    print('ITER %4d perturb: %.5f; sim: %f'
-                          % (iteration, dist_raw_sum / nb_imgs, bottlesim_sum / nb_imgs))
-            if self.verbose == 0:
-                progressbar.update(iteration)
+        loop_start = time.time()
+        if self.steps_per_run > 1 and self.fused_train is not None:
+            iteration = self.run_fused(nb_imgs, progressbar if self.verbose == 0 else None)
+        else:
+            for iteration in range(self.MAX_ITERATIONS):
+
+                # also updates best_adv with the result of the previous step
+                # and retires the images that are done
+                if self.any_active is not None:
+                    _, active = self.sess.run([self.train, self.any_active], feed_dict=feed_dict)
+                    if not active:
+                        break
+                else:
+                    self.sess.run([self.train], feed_dict=feed_dict)
+
+                if iteration != 0 and iteration % (self.MAX_ITERATIONS // 3) == 0 and not self.refill:
+                    LR = LR * 0.8
+                    feed_dict[self.learning_rate_holder] = LR
+
+                if iteration % (self.MAX_ITERATIONS // 5) == 0:
+                    if self.verbose == 1:
+                        dist_raw_sum = float(self.sess.run(self.dist_raw_sum))
+                        bottlesim_sum = self.sess.run(self.bottlesim_sum)
+                        print('ITER %4d perturb: %.5f; sim: %f'
+                              % (iteration, dist_raw_sum / nb_imgs, bottlesim_sum / nb_imgs))
+                if self.verbose == 0:
+                    progressbar.update(iteration)
+
+        # wall time of one optimization step at this batch size, used by the
+        # worker to size its batches
+        self.last_step_time = (time.time() - loop_start) / max(iteration + 1, 1)
+        self.last_steps = iteration + 1
+        # the result of the last step has not been compared yet, also for
+        # the images that stopped early
+        self.sess.run(self.harvest, {self.harvest_mask: np.arange(self.batch_size) < nb_imgs})
 
         if self.verbose == 1:
             loss_sum = float(self.sess.run(self.loss_sum))
@@ -433,5 +751,8 @@ class FawkesMaskGeneration:
                      dist_raw_sum,
                      bottlesim_sum / nb_imgs))
         print("\n")
+        if self.iterations is not None:
+            self.last_iterations.extend(int(n) for n in self.sess.run(self.iterations)[:nb_imgs])
+        best_adv = self.sess.run(self.best_adv)
         best_adv = self.clipping(best_adv[:nb_imgs])
         return best_adv
@@ -0,0 +1,138 @@
+"""Distance and top-k kernels used to rank cloaking targets.
+
+Distances are computed in float32 as ||a||^2 + ||b||^2 - 2 a.b with one GEMM
+per chunk of candidates, reusing precomputed candidate norms, and only the k
+farthest candidates per row are kept (argpartition, no full sort). Ranking
+uses squared distances, the square root is taken on the k survivors only.
+
+    python fawkes/distance.py --rows 20000,100000 --faces 1,8
+
+benchmarks it against the old np.matrix/np.tile float64 path.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+# candidates per GEMM; (faces x CHUNK_SIZE) float32 scratch stays in cache
+CHUNK_SIZE = 8192
+
+
+def iter_sq_distances(A, B, sq_norms_B=None, chunk_size=CHUNK_SIZE):
+    """Yield `(start, D)` where D[i, j] is the squared L2 distance between
+    A[i] and B[start + j], for consecutive chunks of B. B can be a memmap."""
+    A = np.ascontiguousarray(A, dtype=np.float32)
+    sq_norms_A = np.einsum('ij,ij->i', A, A)[:, None]
+    for start in range(0, len(B), chunk_size):
+        b = np.asarray(B[start:start + chunk_size], dtype=np.float32)
+        if sq_norms_B is None:
+            nb = np.einsum('ij,ij->i', b, b)
+        else:
+            nb = np.asarray(sq_norms_B[start:start + chunk_size], dtype=np.float32)
+        d = np.dot(A, b.T)
+        d *= -2.0
+        d += sq_norms_A
+        d += nb
+        np.maximum(d, 0.0, out=d)
+        yield start, d
+
+
+def sq_distances(A, B, sq_norms_B=None, chunk_size=CHUNK_SIZE):
+    """Full (len(A), len(B)) float32 matrix of squared L2 distances."""
+    out = np.empty((len(A), len(B)), dtype=np.float32)
+    for start, d in iter_sq_distances(A, B, sq_norms_B, chunk_size):
+        out[:, start:start + d.shape[1]] = d
+    return out
+
+
+def _top_k(d, k):
+    # unordered indices of the k largest entries per row
+    if d.shape[1] <= k:
+        return np.broadcast_to(np.arange(d.shape[1]), d.shape).copy()
+    return np.argpartition(-d, k - 1, axis=1)[:, :k]
+
+
+def farthest_candidates(A, B, sq_norms_B=None, k=30, reduce=None, chunk_size=CHUNK_SIZE):
+    """Indices into B of the k candidates farthest from each row of A, and
+    their L2 distances, both (rows, k) and sorted farthest first.
+
+    With `reduce='min'` the rows of A are treated as one group: a candidate's
+    distance is its distance to the closest row, and a single row is
+    returned."""
+    rows = 1 if reduce == 'min' else len(A)
+    best_idx = np.empty((rows, 0), dtype=np.int64)
+    best_d = np.empty((rows, 0), dtype=np.float32)
+    for start, d in iter_sq_distances(A, B, sq_norms_B, chunk_size):
+        if reduce == 'min':
+            d = d.min(axis=0, keepdims=True)
+        idx = _top_k(d, k)
+        best_d = np.concatenate([best_d, np.take_along_axis(d, idx, axis=1)], axis=1)
+        best_idx = np.concatenate([best_idx, idx + start], axis=1)
+        if best_d.shape[1] > k:
+            keep = _top_k(best_d, k)
+            best_d = np.take_along_axis(best_d, keep, axis=1)
+            best_idx = np.take_along_axis(best_idx, keep, axis=1)
+    order = np.argsort(-best_d, axis=1, kind='stable')
+    return np.take_along_axis(best_idx, order, axis=1), np.sqrt(np.take_along_axis(best_d, order, axis=1))
+
+
+def _reference_ranking(A, B, k):
+    # what select_target_label used to do: float64 np.matrix/np.tile
+    # distances, then a full argsort per face
+    vecProd = np.dot(A.astype(np.float64), B.astype(np.float64).T)
+    sumSqA = np.matrix(np.sum(A.astype(np.float64) ** 2, axis=1))
+    sumSqAEx = np.tile(sumSqA.transpose(), (1, vecProd.shape[1]))
+    sumSqB = np.sum(B.astype(np.float64) ** 2, axis=1)
+    sumSqBEx = np.tile(sumSqB, (vecProd.shape[0], 1))
+    SqED = sumSqBEx + sumSqAEx - 2 * vecProd
+    SqED[SqED < 0] = 0.0
+    ED = np.asarray(np.sqrt(SqED))
+    np.sort(ED[0], axis=0)
+    return np.argsort(ED, axis=1)[:, ::-1][:, :k]
+
+
+def _time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(*argv):
+    if not argv:
+        argv = list(sys.argv)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=str, default="20000,100000",
+                        help="comma separated candidate table sizes")
+    parser.add_argument('--faces', type=str, default="1,8",
+                        help="comma separated numbers of query faces")
+    parser.add_argument('--dim', type=int, default=1024)
+    parser.add_argument('--k', type=int, default=30)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv[1:])
+
+    rng = np.random.RandomState(0)
+    for rows in [int(r) for r in args.rows.split(',')]:
+        B = rng.randn(rows, args.dim).astype(np.float32)
+        B /= np.linalg.norm(B, axis=1, keepdims=True)
+        sq_norms = np.einsum('ij,ij->i', B, B)
+        for faces in [int(f) for f in args.faces.split(',')]:
+            A = rng.randn(faces, args.dim).astype(np.float32)
+            A /= np.linalg.norm(A, axis=1, keepdims=True)
+
+            old_t, old = _time(lambda: _reference_ranking(A, B, args.k), args.repeat)
+            new_t, (new, _) = _time(lambda: farthest_candidates(A, B, sq_norms, k=args.k,
+                                                                 chunk_size=args.chunk_size), args.repeat)
+            overlap = np.mean([len(set(o) & set(n)) / float(args.k) for o, n in zip(old, new)])
+            print("rows={} faces={} dim={}: old {:.1f}ms, new {:.1f}ms ({:.1f}x), top-{} overlap {:.3f}".format(
+                rows, faces, args.dim, old_t * 1000, new_t * 1000, old_t / new_t, args.k, overlap))
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,145 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# seconds; covers MTCNN on a thumbnail up to a full 'high' mode attack
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0, 300.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Instrumentation(object):
+    """Named stage timers with monotonic, high-resolution clocks.
+
+    Every timed stage lands in a per-stage latency histogram and, when a
+    JSONL path is configured, as one record carrying the stage name, its
+    duration and the current context (batch id, image name, ...). Histograms
+    can be written as a Prometheus text file or served over HTTP.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.jsonl_path = None
+        self._jsonl = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, jsonl_path=None, prometheus_path=None, port=None, interval=15):
+        if jsonl_path:
+            self.jsonl_path = jsonl_path
+            self._jsonl = open(jsonl_path, 'a', buffering=1)
+        if prometheus_path:
+            t = threading.Thread(target=self._write_forever, args=(prometheus_path, interval),
+                                 name="metrics-writer", daemon=True)
+            t.start()
+        if port:
+            self.serve(port)
+        return self
+
+    def _context(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = [{}]
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def context(self, **ctx):
+        """Attach `ctx` to every stage recorded on this thread inside the block."""
+        stack = self._context()
+        merged = dict(stack[-1])
+        merged.update(ctx)
+        stack.append(merged)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    @contextlib.contextmanager
+    def stage(self, name, **ctx):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **ctx)
+
+    def observe(self, name, seconds, **ctx):
+        record = None
+        if self._jsonl is not None:
+            record = dict(self._context()[-1])
+            record.update(ctx)
+            record.update({"stage": name, "seconds": round(seconds, 6), "ts": time.time()})
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(self.buckets)
+            self.histograms[name].observe(seconds)
+            if record is not None:
+                self._jsonl.write(json.dumps(record, default=str) + "\n")
+
+    def prometheus_text(self, metric="fawkes_stage_seconds"):
+        lines = ["# HELP {} Time spent per pipeline stage.".format(metric),
+                 "# TYPE {} histogram".format(metric)]
+        with self._lock:
+            for name in sorted(self.histograms):
+                h = self.histograms[name]
+                cumulative = 0
+                for le, count in zip(list(h.buckets) + ["+Inf"], h.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(metric, name, le, cumulative))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(metric, name, h.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(metric, name, h.count))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
+
+    def _write_forever(self, path, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.write_prometheus(path)
+            except Exception as e:
+                print("could not write metrics:", e)
+
+    def serve(self, port):
+        instrumentation = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = instrumentation.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('', port), Handler)
+        t = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+        t.start()
+        return server
+
+
+# process-wide instance shared by the protector and the worker
+instrumentation = Instrumentation()
+stage = instrumentation.stage
+context = instrumentation.context
@@ -0,0 +1,141 @@
+"""Optimizers FawkesMaskGeneration can run its attack with.
+
+    adadelta  tf.train.AdadeltaOptimizer, what the modes were tuned for
+    adam      tf.train.AdamOptimizer
+    sign      signed-gradient (PGD-style) steps of a fixed size
+
+The mode learning rates are Adadelta's; the others use their own scale,
+DEFAULT_LEARNING_RATES, unless one is given.
+
+    python fawkes/optimizers.py -d imgs/ --mode low --optimizers adadelta,adam,sign
+
+measures how many steps each needs to reach the bottlesim and DSSIM that
+Adadelta reaches with the mode's full schedule.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+OPTIMIZERS = ('adadelta', 'adam', 'sign')
+# step sizes in tanh space, where 0.01 is about 0.6 of a pixel level
+DEFAULT_LEARNING_RATES = {'adadelta': None, 'adam': 0.01, 'sign': 0.005}
+
+
+class SignedGradientOptimizer(tf.train.GradientDescentOptimizer):
+    """Moves every variable entry by the learning rate along the sign of its
+    gradient. Entries with a zero gradient (masked images) do not move."""
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        return super(SignedGradientOptimizer, self).apply_gradients(
+            [(tf.sign(grad), var) for grad, var in grads_and_vars], global_step=global_step, name=name)
+
+
+def make_optimizer(name, learning_rate):
+    """`learning_rate` may be a callable, read when a train op is built."""
+    if name == 'adadelta':
+        return tf.train.AdadeltaOptimizer(learning_rate)
+    if name == 'adam':
+        return tf.train.AdamOptimizer(learning_rate)
+    if name == 'sign':
+        return SignedGradientOptimizer(learning_rate)
+    raise Exception("optimizer must be one of {}".format(", ".join(OPTIMIZERS)))
+
+
+def learning_rate(name, mode_lr, lr=None):
+    """Learning rate to run optimizer `name` with: `lr` if given, else the
+    mode's for Adadelta and the optimizer's default otherwise."""
+    if lr is not None:
+        return lr
+    return DEFAULT_LEARNING_RATES[name] or mode_lr
+
+
+def _dssim(sess, a, b):
+    # same distance the attack optimizes, on raw 0-255 images
+    ssim = sess.run(tf.image.ssim(tf.constant(a, dtype=tf.float32), tf.constant(b, dtype=tf.float32),
+                                  max_val=255.0))
+    return (1.0 - ssim) / 2.0
+
+
+def run_attack(fawkes, job, name, lr, th, max_step, target_bottlesim=0.0):
+    """Attack the faces of `job` as one batch; returns steps per face, best
+    bottlesim per face, DSSIM per face and seconds taken."""
+    from fawkes.differentiator import FawkesMaskGeneration
+    from fawkes.utils import reverse_preprocess
+
+    nb_faces = len(job.original_images)
+    with fawkes.sess.graph.as_default(), fawkes.sess.as_default():
+        kwargs = dict(fawkes.protector_kwargs)
+        kwargs.pop("optimizer_lr", None)
+        kwargs.update(batch_size=nb_faces, learning_rate=lr, max_iterations=max_step, l_threshold=th,
+                      optimizer=name, target_bottlesim=target_bottlesim, min_steps=1, verbose=0)
+        protector = FawkesMaskGeneration(fawkes.sess, fawkes.feature_extractors_ls, **kwargs)
+        start = time.perf_counter()
+        protected = protector.attack(job.original_images, job.target_embedding)
+        elapsed = time.perf_counter() - start
+        bottlesim = fawkes.sess.run(protector.best_bottlesim)[:nb_faces]
+        dssim = _dssim(fawkes.sess, reverse_preprocess(protected, 'imagenet'),
+                       reverse_preprocess(np.copy(job.original_images), 'imagenet'))
+    return np.array(protector.last_iterations), bottlesim, dssim, elapsed
+
+
+def main(*argv):
+    if not argv:
+        argv = list(sys.argv)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', '-d', type=str, default='imgs/',
+                        help="images whose faces are attacked, as one batch")
+    parser.add_argument('--gpu', '-g', type=str, default='0')
+    parser.add_argument('--feature-extractor', type=str, default="high_extract")
+    parser.add_argument('--mode', '-m', type=str, default='low',
+                        help="threshold, steps and Adadelta learning rate of the reference run")
+    parser.add_argument('--optimizers', type=str, default=",".join(OPTIMIZERS))
+    parser.add_argument('--learning-rates', type=str, default=None,
+                        help="comma separated name=lr overrides, e.g. adam=0.02,sign=0.01")
+    parser.add_argument('--max-step', type=int, default=None,
+                        help="step limit for the compared runs, defaults to 3x the mode's")
+    parser.add_argument('--target-bottlesim', type=float, default=None,
+                        help="defaults to the mean bottlesim of the Adadelta reference run")
+    parser.add_argument('--dssim-budget', type=float, default=None,
+                        help="defaults to the mean DSSIM of the Adadelta reference run")
+    args = parser.parse_args(argv[1:])
+
+    from protection_compute_frontloaded import Fawkes
+
+    image_paths = [path for path in glob.glob(os.path.join(args.directory, "*"))
+                   if "_cloaked" not in path.split("/")[-1]]
+    fawkes = Fawkes(args.feature_extractor, args.gpu, 1, modes=[args.mode])
+    job = fawkes.prepare(image_paths, separate_target=True)
+    th, mode_steps, mode_lr = fawkes.mode2param(args.mode)
+    max_step = args.max_step or 3 * mode_steps
+    overrides = dict(pair.split('=') for pair in args.learning_rates.split(',')) if args.learning_rates else {}
+
+    target_bottlesim, dssim_budget = args.target_bottlesim, args.dssim_budget
+    if target_bottlesim is None or dssim_budget is None:
+        _, bottlesim, dssim, elapsed = run_attack(fawkes, job, 'adadelta', mode_lr, th, mode_steps)
+        print("reference: adadelta lr={} {} steps, bottlesim {:.4f}, dssim {:.5f}, {:.1f}s".format(
+            mode_lr, mode_steps, bottlesim.mean(), dssim.mean(), elapsed))
+        if target_bottlesim is None:
+            target_bottlesim = float(bottlesim.mean())
+        if dssim_budget is None:
+            dssim_budget = float(dssim.mean())
+
+    print("operating point: bottlesim <= {:.4f} at dssim <= {:.5f}, {} faces, up to {} steps".format(
+        target_bottlesim, dssim_budget, len(job.original_images), max_step))
+    for name in args.optimizers.split(','):
+        lr = learning_rate(name, mode_lr, float(overrides[name]) if name in overrides else None)
+        steps, bottlesim, dssim, elapsed = run_attack(fawkes, job, name, lr, th, max_step, target_bottlesim)
+        reached = (bottlesim <= target_bottlesim) & (dssim <= dssim_budget)
+        print("{:>8} lr={:<8g} steps mean {:.1f} max {}, reached {}/{}, bottlesim {:.4f}, dssim {:.5f}, "
+              "{:.1f}s".format(name, lr, steps.mean(), steps.max(), int(reached.sum()), len(reached),
+                               bottlesim.mean(), dssim.mean(), elapsed))
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
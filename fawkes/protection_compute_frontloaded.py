@@ -3,10 +3,12 @@
 # from __future__ import print_function
 
 import argparse
+import collections
 import glob
 import logging
 import os
 import sys
+import threading
 import time
 
 import tensorflow as tf
@@ -15,12 +17,24 @@ logging.getLogger('tensorflow').disabled = True
 
 import numpy as np
 from fawkes.differentiator import FawkesMaskGeneration
-from utils import load_extractor, init_gpu, select_target_label, dump_image, reverse_process_cloaked, \
-    Faces, filter_image_paths
+from fawkes.artifacts import ARTIFACT_FORMAT, FrozenExtractor, load_artifact
+from fawkes.instrumentation import instrumentation, stage
+from fawkes.optimizers import learning_rate
+from utils import load_extractor, init_gpu, select_target_label, select_target_labels, dump_image, \
+    reverse_process_cloaked, Faces, filter_image_paths, filter_images, encode_image, load_extractor_weights, \
+    preload_embeddings
 
 from fawkes.align_face import aligner
+from fawkes.detect_faces import load_mtcnn_weights
 from fawkes.utils import get_file
-import datetime
+
+
+# attack graphs are never freed from the TF graph, so only this many
+# distinct mode 'custom' settings are built per process
+MAX_CUSTOM_SETTINGS = 8
+
+# FawkesMaskGeneration's values for the `early_stopping` settings
+EARLY_STOPPING_DEFAULTS = dict(plateau_window=0, target_bottlesim=0.0, stop_at_budget=False)
 
 
 def generate_cloak_images(protector, image_X, target_emb=None):
@@ -38,19 +52,55 @@ def check_imgs(imgs):
     return imgs
 
 
+class ProtectionJob(object):
+    def __init__(self, image_paths, faces, original_images, target_embedding):
+        self.image_paths = image_paths
+        self.faces = faces
+        self.original_images = original_images
+        self.target_embedding = target_embedding
+        # attack steps each face ran for, filled in by cloak
+        self.iterations = None
+
+
 class Fawkes(object):
-    def __init__(self, feature_extractor, gpu, batch_size):
+    def __init__(self, feature_extractor, gpu, batch_size, preloaded=None, intra_op_threads=None,
+                 inter_op_threads=None, artifact=None, modes=None, steps_per_run=1, early_stopping=None,
+                 refill=False, batch_buckets=None, optimizer='adadelta', optimizer_lr=None):
+        # `preloaded` comes from preload_models() in a parent process, so forked
+        # workers build their sessions without re-reading the model files.
+        # `artifact` is a directory written by `python fawkes/artifacts.py`;
+        # the frozen detector, extractors and attack graphs are imported from
+        # it instead of being rebuilt, and must have been compiled with the
+        # settings passed here. Attack graphs for `modes` are built up front,
+        # any other mode or batch size is built on first use.
+        # `steps_per_run` > 1 runs that many attack steps per session call.
+        # `early_stopping` holds FawkesMaskGeneration's per-image stopping
+        # criteria (plateau_window, target_bottlesim, stop_at_budget, ...).
+        # With `refill` a finished face's batch slot goes to the next face.
+        # `batch_buckets` lists the attack graph batch sizes to build up front;
+        # every attack then runs on the smallest of them its faces fit in
+        # instead of on a graph padded to the requested batch size.
+        # `optimizer` is one of fawkes.optimizers.OPTIMIZERS; the mode learning
+        # rates are Adadelta's, others use `optimizer_lr` or their default.
+        self.startup_timings = collections.OrderedDict()
+        phase_start = time.perf_counter()
 
         self.feature_extractor = feature_extractor
         self.gpu = gpu
         self.batch_size = batch_size
+        self.batch_buckets = sorted(batch_buckets) if batch_buckets else None
+        self.attack_lock = threading.Lock()
+        self.last_attack = None
+        self.last_iterations = []
         global sess
-        sess = init_gpu(gpu)
+        sess = init_gpu(gpu, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
         global graph
         graph = tf.get_default_graph()
+        self.sess = sess
+        phase_start = self._timed('session', phase_start)
 
         model_dir = os.path.join(os.path.expanduser('~'), '.fawkes')
-        if not os.path.exists(os.path.join(model_dir, "mtcnn.p.gz")):
+        if artifact is None and not os.path.exists(os.path.join(model_dir, "mtcnn.p.gz")):
             os.makedirs(model_dir, exist_ok=True)
             get_file("mtcnn.p.gz", "http://sandlab.cs.uchicago.edu/fawkes/files/mtcnn.p.gz", cache_dir=model_dir,
                      cache_subdir='')
@@ -59,47 +109,170 @@ class Fawkes(object):
         if isinstance(feature_extractor, list):
             self.fs_names = feature_extractor
 
-        self.aligner = aligner(sess)
-        self.feature_extractors_ls = [load_extractor(name) for name in self.fs_names]
+        self.artifact_manifest = None
+        if artifact is not None:
+            self.artifact_manifest = load_artifact(sess, artifact)
+            phase_start = self._timed('artifact import', phase_start)
+            self.aligner = aligner(sess, frozen=True)
+            self.feature_extractors_ls = [FrozenExtractor(sess, e["input"], e["output"])
+                                          for e in self.artifact_manifest["extractors"]]
+        else:
+            if preloaded is None:
+                preloaded = {"mtcnn": None, "extractors": {}}
+            self.aligner = aligner(sess, dnet_weights=preloaded["mtcnn"])
+            phase_start = self._timed('mtcnn', phase_start)
+            self.feature_extractors_ls = [load_extractor(name, preloaded["extractors"].get(name))
+                                          for name in self.fs_names]
+        phase_start = self._timed('extractors', phase_start)
 
         global protector
         global protector_param
 
-        mode='low'
-        th=0.04
-        sd=1e9
-        lr=10
-        max_step=500
-        batch_size=1
-        format='png'
-        separate_target=True
-        debug=False
-        th, max_step, lr = self.mode2param(mode)
-
-        protector_param = "-".join([str(x) for x in [mode, th, sd, lr, max_step, batch_size, format, separate_target, debug]])
-
-        print('h', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-
-        print('i', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        protector = FawkesMaskGeneration(sess, self.feature_extractors_ls,
-                                          batch_size=batch_size,
-                                          mimic_img=True,
-                                          intensity_range='imagenet',
-                                          initial_const=sd,
-                                          learning_rate=lr,
-                                          max_iterations=max_step,
-                                          l_threshold=th,
-                                          verbose=1 if debug else 0,
-                                          maximize=False,
-                                          keep_final=False,
-                                          image_shape=(224, 224, 3))
-
-
-        print('j', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        with sess.as_default():
-            print("hello")
-
-
+        # settings shared by every attack graph; threshold, lr, steps and sd
+        # come from the requested mode
+        self.protector_kwargs = dict(mimic_img=True,
+                                     intensity_range='imagenet',
+                                     maximize=False,
+                                     keep_final=False,
+                                     image_shape=(224, 224, 3),
+                                     steps_per_run=steps_per_run,
+                                     refill=refill,
+                                     optimizer=optimizer,
+                                     optimizer_lr=optimizer_lr)
+        self.protector_kwargs.update(early_stopping or {})
+        # attack graphs have a fixed batch dimension and bake in the
+        # threshold, keep one per batch size and setting
+        self.protectors = {}
+        self.protector_params = {}
+        self.custom_settings = set()
+        if self.artifact_manifest is not None:
+            self._check_artifact(modes or ['low'])
+            for entry in self.artifact_manifest["protectors"]:
+                params = entry["params"]
+                key = self.protector_key(**params)
+                self.protectors[key] = FawkesMaskGeneration(sess, None, manifest=entry["handles"],
+                                                            **self._attack_kwargs(**params))
+                self.protector_params[key] = params
+        for mode in modes or ['low']:
+            for size in self.batch_buckets or [self.batch_size]:
+                self.get_protector(size, mode=mode)
+        protector = self.get_protector(self.bucket(self.batch_size) if self.batch_buckets else self.batch_size)
+        protector_param = self.param_string(batch_size=self.batch_size)
+        phase_start = self._timed('attack graphs', phase_start)
+
+        print("startup: " + ", ".join("{} {:.2f}s".format(k, v) for k, v in self.startup_timings.items()) +
+              ", total {:.2f}s".format(sum(self.startup_timings.values())))
+
+    def _check_artifact(self, modes):
+        """Raise unless the artifact was compiled with the requested
+        extractors and attack settings and holds a graph for every mode and
+        batch size asked for; its graphs bake all of them in."""
+        manifest = self.artifact_manifest
+        errors = []
+        if manifest.get("format") != ARTIFACT_FORMAT:
+            errors.append("format {} (this code reads {}), compile it again".format(manifest.get("format"),
+                                                                                 ARTIFACT_FORMAT))
+        if list(manifest["feature_extractors"]) != list(self.fs_names):
+            errors.append("feature extractors {} (requested {})".format(manifest["feature_extractors"],
+                                                                       self.fs_names))
+        compiled = dict(EARLY_STOPPING_DEFAULTS, **manifest["protector_kwargs"])
+        requested = dict(EARLY_STOPPING_DEFAULTS, **self.protector_kwargs)
+        requested["image_shape"] = list(requested["image_shape"])
+        for name in sorted(set(compiled) | set(requested)):
+            if compiled.get(name) != requested.get(name):
+                errors.append("{}={!r} (requested {!r})".format(name, compiled.get(name), requested.get(name)))
+        compiled_keys = set(self.protector_key(**entry["params"]) for entry in manifest["protectors"])
+        for mode in modes:
+            for size in self.batch_buckets or [self.batch_size]:
+                params = dict(self.resolve_params(mode), batch_size=size)
+                if self.protector_key(**params) not in compiled_keys:
+                    errors.append("no graph for mode {} at batch size {}".format(mode, size))
+        if errors:
+            raise Exception("artifact does not match the requested settings: " + "; ".join(errors))
+
+    def _timed(self, phase, phase_start):
+        now = time.perf_counter()
+        self.startup_timings[phase] = now - phase_start
+        instrumentation.observe('startup_' + phase.replace(' ', '_'), now - phase_start)
+        return now
+
+    def resolve_params(self, mode='low', th=None, sd=1e9, lr=None, max_step=None):
+        """Attack settings for `mode`. `th`, `lr` and `max_step` are only
+        read in mode 'custom', where they are rounded so near-identical
+        requests share an attack graph; named modes ignore them."""
+        if mode != 'custom':
+            th, max_step, lr = self.mode2param(mode)
+        else:
+            th, lr, max_step = round(float(th), 4), round(float(lr), 2), int(max_step)
+        return dict(th=th, sd=sd, lr=lr, max_step=max_step)
+
+    @staticmethod
+    def protector_key(batch_size, th, sd, lr, max_step):
+        return (int(batch_size), float(th), float(sd), float(lr), int(max_step))
+
+    def param_string(self, mode='low', th=None, sd=1e9, lr=None, max_step=None, batch_size=1, format='png',
+                     separate_target=True, debug=False):
+        params = self.resolve_params(mode, th, sd, lr, max_step)
+        fields = [mode, params["th"], sd, params["lr"], params["max_step"], batch_size, format, separate_target,
+                  debug]
+        optimizer = self.protector_kwargs.get("optimizer", "adadelta")
+        if optimizer != "adadelta":
+            fields += [optimizer, learning_rate(optimizer, params["lr"], self.protector_kwargs.get("optimizer_lr"))]
+        return "-".join([str(x) for x in fields])
+
+    def _attack_kwargs(self, batch_size, th, sd, lr, max_step):
+        kwargs = dict(self.protector_kwargs)
+        optimizer_lr = kwargs.pop("optimizer_lr", None)
+        kwargs.update(batch_size=batch_size, initial_const=sd,
+                      learning_rate=learning_rate(kwargs.get("optimizer", "adadelta"), lr, optimizer_lr),
+                      max_iterations=max_step, l_threshold=th, verbose=0)
+        return kwargs
+
+    def get_protector(self, batch_size=1, mode='low', th=None, sd=1e9, lr=None, max_step=None):
+        params = self.resolve_params(mode, th, sd, lr, max_step)
+        params["batch_size"] = batch_size
+        key = self.protector_key(**params)
+        if key not in self.protectors:
+            if self.artifact_manifest is not None:
+                raise Exception("attack graph {} was not compiled into the artifact".format(key))
+            if mode == 'custom':
+                if key[1:] not in self.custom_settings and len(self.custom_settings) >= MAX_CUSTOM_SETTINGS:
+                    raise Exception("already built attack graphs for {} custom settings".format(
+                        MAX_CUSTOM_SETTINGS))
+                self.custom_settings.add(key[1:])
+            with graph.as_default(), sess.as_default():
+                self.protectors[key] = FawkesMaskGeneration(sess, self.feature_extractors_ls,
+                                                            **self._attack_kwargs(**params))
+            self.protector_params[key] = params
+        return self.protectors[key]
+
+    def bucket(self, nb_faces):
+        """Smallest batch bucket holding `nb_faces`, or the largest one."""
+        for size in self.batch_buckets:
+            if size >= nb_faces:
+                return size
+        return self.batch_buckets[-1]
+
+    def plan_batches(self, nb_faces, batch_size):
+        """Split `nb_faces` faces into `(graph batch size, faces)` chunks.
+        Without buckets that is a single chunk on the requested graph. With
+        buckets, full chunks use the largest bucket up to `batch_size` and
+        the rest the smallest bucket it fits in, so 11 faces at batch size 8
+        run as 8 + 3 on the 8 and 4 graphs rather than as 16. Refilled
+        graphs keep their slots busy, they only shrink to fit small jobs."""
+        if nb_faces == 0:
+            return []
+        if not self.batch_buckets:
+            return [(batch_size, nb_faces)]
+        full = max([size for size in self.batch_buckets if size <= batch_size] or [self.batch_buckets[0]])
+        if self.protector_kwargs.get("refill"):
+            return [(self.bucket(min(nb_faces, full)), nb_faces)]
+        chunks = []
+        while nb_faces > 0:
+            size = self.bucket(min(nb_faces, full))
+            chunks.append((size, min(size, nb_faces)))
+            nb_faces -= chunks[-1][1]
+        return chunks
 
     def mode2param(self, mode):
         if mode == 'low':
@@ -128,55 +301,120 @@ class Fawkes(object):
 
     def run_protection(self, image_paths, mode='low', th=0.04, sd=1e9, lr=10, max_step=500, batch_size=1, format='png',
                        separate_target=True, debug=False):
+        # `image_paths` is either a list of files on disk, whose cloaked copies
+        # are written next to them, or a dict mapping names to encoded bytes /
+        # decoded arrays, in which case a dict of name -> cloaked jpeg bytes
+        # is returned and nothing touches the disk.
+        in_memory = isinstance(image_paths, dict)
+        job = self.prepare(image_paths, separate_target=separate_target)
+        protected_images = self.cloak(job, batch_size=batch_size, mode=mode, th=th, sd=sd, lr=lr,
+                                      max_step=max_step, debug=debug)
+
+        if in_memory:
+            results = self.finish(job, protected_images, format=format)
+            print("Done!")
+            return results
+
+        final_images = self.merge(job, protected_images)
+        with stage('dump'):
+            for p_img, path in zip(final_images, job.image_paths):
+                file_name = "{}_{}_cloaked.{}".format(".".join(path.split(".")[:-1]), mode, format)
+                dump_image(p_img, file_name, format=format)
+        print("Done!")
+        return None
 
+    # run_protection is split into prepare -> cloak -> finish so the worker can
+    # run detection, the attack and encoding in separate pipeline stages.
+    # prepare and finish are safe to call from several threads; cloak
+    # serializes access to the shared attack graph.
 
-
-        image_paths, loaded_images = filter_image_paths(image_paths)
+    def prepare(self, image_paths, separate_target=True):
+        """Decode images, detect faces and pick targets. Raises
+        FaceNotFoundError if no image contains a face."""
+        with stage('decode'):
+            if isinstance(image_paths, dict):
+                image_paths, loaded_images = filter_images(image_paths)
+            else:
+                image_paths, loaded_images = filter_image_paths(image_paths)
 
         if not image_paths:
             raise Exception("No images in the directory")
 
-        faces = Faces(image_paths, loaded_images, self.aligner, verbose=1)
-        print('d', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-
-        original_images = faces.cropped_faces
-        original_images = np.array(original_images)
-
-        print('e', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        if separate_target:
-            target_embedding = []
-            for org_img in original_images:
-                org_img = org_img.reshape([1] + list(org_img.shape))
-                tar_emb = select_target_label(org_img, self.feature_extractors_ls, self.fs_names)
-                target_embedding.append(tar_emb)
-            target_embedding = np.concatenate(target_embedding)
-            print('f', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        else:
-            target_embedding = select_target_label(original_images, self.feature_extractors_ls, self.fs_names)
-            print('g', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-
-
-        protected_images = generate_cloak_images(protector, original_images,
-                                                 target_emb=target_embedding)
-        print('k', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        faces.cloaked_cropped_faces = protected_images
-        print('l', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        cloak_perturbation = reverse_process_cloaked(protected_images) - reverse_process_cloaked(
-            original_images)
-        print('m', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        final_images = faces.merge_faces(cloak_perturbation)
-        print('n', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-
-        for p_img, path in zip(final_images, image_paths):
-            file_name = "{}_{}_cloaked.{}".format(".".join(path.split(".")[:-1]), mode, format)
-            dump_image(p_img, file_name, format=format)
-        print('o', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        print("Done!")
-        return None
+        with graph.as_default(), sess.as_default():
+            with stage('detect', images=len(image_paths)):
+                faces = Faces(image_paths, loaded_images, self.aligner, verbose=1)
+
+            original_images = faces.cropped_faces
+            original_images = np.array(original_images)
+
+            with stage('target_select', faces=len(original_images), separate_target=separate_target):
+                if separate_target:
+                    target_embedding = select_target_labels(original_images, self.feature_extractors_ls,
+                                                            self.fs_names)
+                else:
+                    target_embedding = select_target_label(original_images, self.feature_extractors_ls,
+                                                           self.fs_names)
+
+        return ProtectionJob(image_paths, faces, original_images, target_embedding)
+
+    def cloak(self, job, batch_size=None, mode='low', th=None, sd=1e9, lr=None, max_step=None, debug=False):
+        protected_images = self.cloak_faces(job.original_images, job.target_embedding, batch_size=batch_size,
+                                            mode=mode, th=th, sd=sd, lr=lr, max_step=max_step, debug=debug)
+        job.iterations = self.last_iterations
+        return protected_images
+
+    def cloak_faces(self, faces, targets, batch_size=None, mode='low', th=None, sd=1e9, lr=None, max_step=None,
+                    debug=False):
+        """Cloak preprocessed faces against one target image each. The faces
+        may come from several jobs; the worker packs them into batches."""
+        with self.attack_lock, graph.as_default(), sess.as_default():
+            protected_images = []
+            iterations = []
+            attacks = []
+            start = 0
+            for size, nb_faces in self.plan_batches(len(faces), batch_size or self.batch_size):
+                cur_protector = self.get_protector(size, mode=mode, th=th, sd=sd, lr=lr, max_step=max_step)
+                cur_protector.verbose = 1 if debug else 0
+                with stage('attack', faces=nb_faces, batch_size=cur_protector.batch_size, mode=mode):
+                    protected_images.extend(generate_cloak_images(cur_protector, faces[start:start + nb_faces],
+                                                                  target_emb=targets[start:start + nb_faces]))
+                iterations.extend(cur_protector.last_iterations)
+                attacks.append((cur_protector.batch_size, cur_protector.last_step_time,
+                                cur_protector.last_steps or cur_protector.MAX_ITERATIONS))
+                start += nb_faces
+            # the first chunk ran on the planned batch size; without faces
+            # nothing ran
+            self.last_attack = attacks[0] if attacks else None
+            self.last_iterations = iterations
+            return np.array(protected_images)
+
+    def merge(self, job, protected_images):
+        with stage('merge'):
+            job.faces.cloaked_cropped_faces = protected_images
+            cloak_perturbation = reverse_process_cloaked(protected_images) - reverse_process_cloaked(
+                job.original_images)
+            return job.faces.merge_faces(cloak_perturbation)
+
+    def finish(self, job, protected_images, format='png'):
+        """Merge the cloaked faces back and return name -> encoded jpeg bytes."""
+        final_images = self.merge(job, protected_images)
+        results = {}
+        for p_img, name in zip(final_images, job.image_paths):
+            with stage('encode', image=name):
+                results[name] = encode_image(p_img, format=format)
+        return results
+
+
+def preload_models(feature_extractor):
+    """Load MTCNN weights, extractor weights and target embeddings into plain
+    numpy memory without creating a TF session, so it is safe to fork after."""
+    fs_names = feature_extractor if isinstance(feature_extractor, list) else [feature_extractor]
+    preload_embeddings(fs_names)
+    return {"mtcnn": load_mtcnn_weights(),
+            "extractors": {name: load_extractor_weights(name) for name in fs_names}}
 
 
 def main(*argv):
-    print('a', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
     if not argv:
         argv = list(sys.argv)
 
@@ -205,14 +443,19 @@ def main(*argv):
     parser.add_argument('--lr', type=float, default=2)
 
     parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--batch-buckets', type=str, default=None,
+                        help="comma separated attack graph batch sizes, faces run on the smallest that fits")
     parser.add_argument('--separate_target', action='store_true')
     parser.add_argument('--debug', action='store_true')
 
     parser.add_argument('--format', type=str,
                         help="final image format",
                         default="png")
+    parser.add_argument('--metrics-jsonl', type=str, default=None,
+                        help="append per-stage timing records to this file")
 
     args = parser.parse_args(argv[1:])
+    instrumentation.configure(jsonl_path=args.metrics_jsonl)
 
     assert args.format in ['png', 'jpg', 'jpeg']
     if args.format == 'jpg':
@@ -220,13 +463,15 @@ def main(*argv):
 
     image_paths = glob.glob(os.path.join(args.directory, "*"))
     image_paths = [path for path in image_paths if "_cloaked" not in path.split("/")[-1]]
-    print('b', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-    protector = Fawkes(args.feature_extractor, args.gpu, args.batch_size)
-    print('c', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-    protector.run_protection(image_paths, mode=args.mode, th=args.th, sd=args.sd, lr=args.lr, max_step=args.max_step,
-                             batch_size=args.batch_size, format=args.format,
-                             separate_target=args.separate_target, debug=args.debug)
-    print('z', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
+    batch_buckets = [int(b) for b in args.batch_buckets.split(',')] if args.batch_buckets else None
+    protector = Fawkes(args.feature_extractor, args.gpu, args.batch_size, modes=[args.mode],
+                       batch_buckets=batch_buckets)
+    with stage('run_protection', images=len(image_paths)):
+        protector.run_protection(image_paths, mode=args.mode, th=args.th, sd=args.sd, lr=args.lr,
+                                 max_step=args.max_step, batch_size=args.batch_size, format=args.format,
+                                 separate_target=args.separate_target, debug=args.debug)
+    for name, h in sorted(instrumentation.histograms.items()):
+        print("{}: {} x, {:.3f}s total".format(name, h.count, h.sum))
 
 
 if __name__ == '__main__':
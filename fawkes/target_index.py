@@ -0,0 +1,282 @@
+"""Precomputed target embedding index for select_target_label.
+
+The pickled `{name}_emb.p.gz` dictionaries are converted once into a float32
+matrix with the excluded targets already removed, the squared row norms and
+an id table, stored as .npy files next to the models. With --targets the
+images under ~/.fawkes/target_data are packed too, resized to 224x224 and
+preprocessed, into one array sliced per target through an offset table:
+
+    python fawkes/target_index.py --feature-extractor high_extract --targets
+
+Workers memory-map them on first use (or in preload_models, before forking,
+so every child shares the same pages). The index records the mtime and size
+of the pickles it was built from and is rebuilt when they change.
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import pickle
+import sys
+import threading
+
+import numpy as np
+
+# target identities never picked as a cloaking target
+EXCLUDED_TARGETS = frozenset([
+    1691, 19236, 20552, 9231, 18221, 8250, 18785, 6989, 17170,
+    1704, 19394, 6058, 3327, 11885, 20375, 19150, 676, 11663,
+    17261, 3527, 3956, 1973, 1197, 4859, 590, 13873, 928,
+    14397, 4288, 3393, 6975, 16988, 1269, 323, 6409, 588,
+    19738, 1845, 12123, 2714, 5318, 15325, 19268, 4650, 4714,
+    3953, 6715, 6015, 12668, 13933, 14306, 2768, 20597, 4578,
+    1278, 17549, 19355, 8882, 3276, 9148, 14517, 14915, 18209,
+    3162, 8615, 18647, 749, 19259, 11490, 16046, 13259, 4429,
+    10705, 12258, 13699, 4323, 15112, 14170, 3520, 17180, 5195,
+    728, 2680, 13117, 20241, 15320, 8079, 2894, 11533, 10083,
+    9628, 14944, 13124, 13316, 8006, 15353, 15261, 8865, 1213,
+    1469, 20777, 9868, 10972, 9058, 18890, 13178, 13772, 15675,
+    10572, 8771, 14211, 18781, 16347, 17985, 11456, 5849, 15709,
+    20856, 2590, 15964, 8377, 5465, 16928, 13063, 19766, 19643,
+    8651, 8517, 5985, 14817, 18926, 3791, 1864, 20061, 7697,
+    13449, 19525, 13131, 421, 7629, 14689, 17521, 4509, 19374,
+    17584, 11055, 11929, 17117, 7492, 14182, 409, 14294, 15033,
+    10074, 9081, 7682, 19306, 3674, 945, 13211, 10933, 17953,
+    12729, 8087, 20723, 5396, 14015, 20110, 15186, 6939, 239,
+    2393, 17326, 13712, 9921, 7997, 6215, 14582, 864, 18906,
+    9351, 9178, 3600, 18567, 8614, 19429, 286, 10042, 13030,
+    7076, 3370, 15285, 7925, 10851, 5155, 14732, 12051, 11334,
+    17035, 15476])
+
+EMBEDDINGS_FILE = "embeddings.npy"
+NORMS_FILE = "sq_norms.npy"
+IDS_FILE = "ids.npy"
+TARGETS_FILE = "targets.npy"
+OFFSETS_FILE = "target_offsets.npy"
+TARGET_IDS_FILE = "target_ids.npy"
+SOURCE_FILE = "source.json"
+TARGET_SHAPE = (224, 224, 3)
+
+
+def model_dir():
+    return os.path.join(os.path.expanduser('~'), '.fawkes')
+
+
+def embeddings_path(extractor_name):
+    return os.path.join(model_dir(), "{}_emb.p.gz".format(extractor_name))
+
+
+def source_signature(feature_extractors_names):
+    """Name, mtime and size of the pickles an index is built from."""
+    signature = []
+    for extractor_name in feature_extractors_names:
+        path = embeddings_path(extractor_name)
+        signature.append([os.path.basename(path), os.path.getmtime(path), os.path.getsize(path)])
+    return signature
+
+
+def read_embeddings(feature_extractors_names):
+    """Read the pickled embeddings of each extractor and concatenate them per
+    target id."""
+    dictionaries = []
+    for extractor_name in feature_extractors_names:
+        fp = gzip.open(embeddings_path(extractor_name), 'rb')
+        path2emb = pickle.load(fp)
+        fp.close()
+        dictionaries.append(path2emb)
+
+    merge_dict = {}
+    for k in dictionaries[0].keys():
+        cur_emb = [dic[k] for dic in dictionaries]
+        merge_dict[k] = np.concatenate(cur_emb)
+    return merge_dict
+
+
+def index_dir(feature_extractors_names):
+    return os.path.join(model_dir(), "{}_emb_index".format("-".join(feature_extractors_names)))
+
+
+class EmbeddingIndex(object):
+    """Target embeddings as one (n, d) float32 matrix, row i belonging to
+    target `ids[i]`, with `sq_norms[i]` = ||embeddings[i]||^2. When a packed
+    target archive exists, the images of row i are
+    `targets[target_offsets[i]:target_offsets[i + 1]]`."""
+
+    def __init__(self, embeddings, sq_norms, ids, targets=None, target_offsets=None):
+        self.embeddings = embeddings
+        self.sq_norms = sq_norms
+        self.ids = ids
+        self.targets = targets
+        self.target_offsets = target_offsets
+
+    def __len__(self):
+        return len(self.ids)
+
+    def target_images(self, row):
+        """Preprocessed target images of `row` as a view into the archive, or
+        None if there is no archive or it has no images for this target."""
+        if self.targets is None:
+            return None
+        start, end = self.target_offsets[row], self.target_offsets[row + 1]
+        if start == end:
+            return None
+        return self.targets[start:end]
+
+
+def _tmp_path(directory, name):
+    # unique per process and thread, so forked workers building the same
+    # index at once never write into each other's file
+    return os.path.join(directory, "{}.{}.{}.tmp".format(name, os.getpid(), threading.get_ident()))
+
+
+def _save(directory, name, array):
+    # write under a temporary name so a half written index is never loaded
+    tmp = _tmp_path(directory, name)
+    with open(tmp, 'wb') as f:
+        np.save(f, array, allow_pickle=False)
+    os.replace(tmp, os.path.join(directory, name))
+
+
+def build_embedding_index(feature_extractors_names, output_dir=None):
+    output_dir = output_dir or index_dir(feature_extractors_names)
+    signature = source_signature(feature_extractors_names)
+    path2emb = read_embeddings(feature_extractors_names)
+    items = [(k, v) for k, v in path2emb.items() if k not in EXCLUDED_TARGETS]
+    ids = np.array([k for k, _ in items])
+    embeddings = np.ascontiguousarray(np.array([v for _, v in items], dtype=np.float32))
+    sq_norms = np.einsum('ij,ij->i', embeddings, embeddings)
+
+    os.makedirs(output_dir, exist_ok=True)
+    _save(output_dir, EMBEDDINGS_FILE, embeddings)
+    _save(output_dir, NORMS_FILE, sq_norms)
+    _save(output_dir, IDS_FILE, ids)
+    # written last: an index without it, or with another one, is rebuilt
+    tmp = _tmp_path(output_dir, SOURCE_FILE)
+    with open(tmp, 'w') as f:
+        json.dump(signature, f)
+    os.replace(tmp, os.path.join(output_dir, SOURCE_FILE))
+    return EmbeddingIndex(embeddings, sq_norms, ids)
+
+
+def index_is_current(directory, feature_extractors_names):
+    """Whether `directory` holds an index built from the current pickles."""
+    if not os.path.exists(os.path.join(directory, IDS_FILE)):
+        return False
+    try:
+        signature = source_signature(feature_extractors_names)
+    except OSError:
+        # the pickles are not shipped, the index is all there is
+        return True
+    try:
+        with open(os.path.join(directory, SOURCE_FILE), 'r') as f:
+            return json.load(f) == signature
+    except (OSError, ValueError):
+        return False
+
+
+def load_target_dir(target_dir):
+    """Decode, resize and preprocess the images of one target the way
+    select_target_label used to on every call."""
+    from keras.preprocessing import image
+    from skimage.transform import resize
+    from fawkes.utils import preprocess
+
+    image_paths = sorted(glob.glob(os.path.join(target_dir, "*.jpg")))
+    if not image_paths:
+        return np.zeros((0,) + TARGET_SHAPE, dtype=np.float32)
+    target_images = [image.img_to_array(image.load_img(cur_path)) for cur_path in image_paths]
+    target_images = np.array([resize(x, TARGET_SHAPE[:2]) for x in target_images])
+    return preprocess(target_images, 'imagenet').astype(np.float32)
+
+
+def build_target_archive(ids, output_dir, target_root=None):
+    """Pack the target images of every id, in index order, into TARGETS_FILE
+    with OFFSETS_FILE giving each row's slice. Ids without images on disk
+    get an empty slice. The ids are kept in TARGET_IDS_FILE, an archive
+    whose ids differ from the index's is not used."""
+    target_root = target_root or os.path.join(model_dir(), "target_data")
+    counts = [len(glob.glob(os.path.join(target_root, str(target_id), "*.jpg"))) for target_id in ids]
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    # filled in place on disk, the whole archive never has to fit in memory
+    tmp = _tmp_path(output_dir, TARGETS_FILE)
+    targets = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                        shape=(int(offsets[-1]),) + TARGET_SHAPE)
+    for row, target_id in enumerate(ids):
+        if counts[row] == 0:
+            continue
+        images = load_target_dir(os.path.join(target_root, str(target_id)))
+        targets[offsets[row]:offsets[row] + len(images)] = images
+    targets.flush()
+    del targets
+    os.replace(tmp, os.path.join(output_dir, TARGETS_FILE))
+    _save(output_dir, TARGET_IDS_FILE, np.asarray(ids))
+    _save(output_dir, OFFSETS_FILE, offsets)
+    return offsets
+
+
+def open_embedding_index(directory):
+    ids = np.load(os.path.join(directory, IDS_FILE), mmap_mode='r')
+    targets, target_offsets = None, None
+    if os.path.exists(os.path.join(directory, OFFSETS_FILE)):
+        ids_path = os.path.join(directory, TARGET_IDS_FILE)
+        if os.path.exists(ids_path) and np.array_equal(np.load(ids_path), ids):
+            targets = np.load(os.path.join(directory, TARGETS_FILE), mmap_mode='r')
+            target_offsets = np.load(os.path.join(directory, OFFSETS_FILE))
+        else:
+            print("target archive in {} was packed for another index, not using it; "
+                  "rebuild it with --targets".format(directory))
+    return EmbeddingIndex(np.load(os.path.join(directory, EMBEDDINGS_FILE), mmap_mode='r'),
+                          np.load(os.path.join(directory, NORMS_FILE), mmap_mode='r'),
+                          ids, targets, target_offsets)
+
+
+# one index per process, keyed by extractor names
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_embedding_index(feature_extractors_names):
+    key = tuple(feature_extractors_names)
+    index = _indexes.get(key)
+    if index is not None:
+        return index
+    with _indexes_lock:
+        if key not in _indexes:
+            directory = index_dir(feature_extractors_names)
+            if not index_is_current(directory, feature_extractors_names):
+                print("building target embedding index in {}".format(directory))
+                build_embedding_index(feature_extractors_names, directory)
+            _indexes[key] = open_embedding_index(directory)
+        return _indexes[key]
+
+
+def main(*argv):
+    if not argv:
+        argv = list(sys.argv)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feature-extractor', type=str, default="high_extract",
+                        help="comma separated extractor names, in the order the protector uses them")
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help="defaults to ~/.fawkes/<names>_emb_index, where workers look for it")
+    parser.add_argument('--targets', action='store_true',
+                        help="also pack the preprocessed target images")
+    parser.add_argument('--target-root', type=str, default=None,
+                        help="directory with one folder of jpgs per target id, defaults to ~/.fawkes/target_data")
+    args = parser.parse_args(argv[1:])
+
+    names = args.feature_extractor.split(',')
+    output_dir = args.output or index_dir(names)
+    index = build_embedding_index(names, output_dir)
+    print("indexed {} targets of dimension {}".format(len(index), index.embeddings.shape[1]))
+    if args.targets:
+        offsets = build_target_archive(index.ids, output_dir, args.target_root)
+        print("packed {} target images for {} targets".format(offsets[-1], int(np.count_nonzero(np.diff(offsets)))))
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
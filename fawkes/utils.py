@@ -1,9 +1,8 @@
 import errno
 import glob
-import gzip
+import io
 import json
 import os
-import pickle
 import random
 import shutil
 import sys
@@ -29,8 +28,10 @@ from keras.preprocessing import image
 from skimage.transform import resize
 
 from fawkes.align_face import align
+from fawkes.instrumentation import stage
+from fawkes.distance import farthest_candidates, sq_distances
+from fawkes.target_index import load_embedding_index
 from six.moves.urllib.request import urlopen
-import time
 import datetime
 
 if sys.version_info[0] == 2:
@@ -67,6 +68,9 @@ def clip_img(X, preprocessing='raw'):
 
 
 def load_image(path):
+    # `path` may also be encoded image bytes or a file-like object
+    if isinstance(path, (bytes, bytearray)):
+        path = io.BytesIO(path)
     try:
         img = Image.open(path)
     except PIL.UnidentifiedImageError:
@@ -110,6 +114,26 @@ def filter_image_paths(image_paths):
     return new_image_paths, new_images
 
 
+def filter_images(named_images):
+    """In-memory counterpart of filter_image_paths: `named_images` maps a name
+    to encoded bytes, a file-like object or an already decoded array."""
+    print("Identify {} files in memory".format(len(named_images)))
+    new_names = []
+    new_images = []
+    for name, data in named_images.items():
+        if isinstance(data, np.ndarray):
+            img = data.astype(np.float32)
+        else:
+            img = load_image(data)
+        if img is None:
+            print("{} is not an image file, skipped".format(name))
+            continue
+        new_names.append(name)
+        new_images.append(img)
+    print("Identify {} images in memory".format(len(new_names)))
+    return new_names, new_images
+
+
 class Faces(object):
     def __init__(self, image_paths, loaded_images, aligner, verbose=1, eval_local=False):
         self.image_paths = image_paths
@@ -214,7 +238,7 @@ def load_victim_model(number_classes, teacher_model=None, end2end=False, dropout
     return model
 
 
-def init_gpu(gpu_index, force=False):
+def init_gpu(gpu_index, force=False, intra_op_threads=None, inter_op_threads=None):
     if isinstance(gpu_index, list):
         gpu_num = ','.join([str(i) for i in gpu_index])
     else:
@@ -223,11 +247,11 @@ def init_gpu(gpu_index, force=False):
     #    print('GPU already initiated')
     #    return
     os.environ["CUDA_VISIBLE_DEVICES"] = gpu_num
-    sess = fix_gpu_memory()
+    sess = fix_gpu_memory(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
     return sess
 
 
-def fix_gpu_memory(mem_fraction=1):
+def fix_gpu_memory(mem_fraction=1, intra_op_threads=None, inter_op_threads=None):
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
     tf_config = None
     if tf.test.is_gpu_available():
@@ -235,6 +259,12 @@ def fix_gpu_memory(mem_fraction=1):
         tf_config = tf.ConfigProto(gpu_options=gpu_options)
         tf_config.gpu_options.allow_growth = True
         tf_config.log_device_placement = False
+    if intra_op_threads or inter_op_threads:
+        # several worker processes share the box, keep each session to its cores
+        if tf_config is None:
+            tf_config = tf.ConfigProto()
+        tf_config.intra_op_parallelism_threads = intra_op_threads or 0
+        tf_config.inter_op_parallelism_threads = inter_op_threads or 0
     init_op = tf.global_variables_initializer()
     sess = tf.Session(config=tf_config)
     sess.run(init_op)
@@ -360,13 +390,42 @@ def build_bottleneck_model(model, cut_off):
     return bottleneck_model
 
 
-def load_extractor(name):
+def load_extractor_weights(name):
+    """Read an extractor's architecture and weights from its .h5 file as plain
+    numpy arrays, without building a graph or session. Used to preload models
+    in a parent process before forking workers."""
+    import h5py
+    model_dir = os.path.join(os.path.expanduser('~'), '.fawkes')
+    model_file = os.path.join(model_dir, "{}.h5".format(name))
+
+    def _str(x):
+        return x.decode('utf8') if isinstance(x, bytes) else x
+
+    with h5py.File(model_file, 'r') as f:
+        model_config = _str(f.attrs['model_config'])
+        weights_group = f['model_weights']
+        layer_weights = {}
+        for layer_name in weights_group.attrs['layer_names']:
+            layer_name = _str(layer_name)
+            g = weights_group[layer_name]
+            layer_weights[layer_name] = [np.asarray(g[_str(w)]) for w in g.attrs['weight_names']]
+    return model_config, layer_weights
+
+
+def load_extractor(name, preloaded=None):
     model_dir = os.path.join(os.path.expanduser('~'), '.fawkes')
     os.makedirs(model_dir, exist_ok=True)
     model_file = os.path.join(model_dir, "{}.h5".format(name))
     emb_file = os.path.join(model_dir, "{}_emb.p.gz".format(name))
     #if os.path.exists(model_file):
-    model = keras.models.load_model(model_file)
+    if preloaded is not None:
+        model_config, layer_weights = preloaded
+        model = keras.models.model_from_json(model_config)
+        for layer in model.layers:
+            if layer.name in layer_weights:
+                layer.set_weights(layer_weights[layer.name])
+    else:
+        model = keras.models.load_model(model_file)
     #else:
     #    print("Download models...")
     #    get_file("{}.h5".format(name), "http://sandlab.cs.uchicago.edu/fawkes/files/{}.h5".format(name),
@@ -409,6 +468,14 @@ def dump_image(x, filename, format="png", scale=False):
     return
 
 
+def encode_image(x, format="png", scale=False):
+    # same output as dump_image, but returns the encoded jpeg bytes
+    img = image.array_to_img(x)
+    buf = io.BytesIO()
+    img.save(buf, 'jpeg')
+    return buf.getvalue()
+
+
 def load_dir(path):
     assert os.path.exists(path)
     x_ls = []
@@ -421,20 +488,9 @@ def load_dir(path):
     return preprocess(raw_x, 'imagenet')
 
 
-def load_embeddings(feature_extractors_names):
-    model_dir = os.path.join(os.path.expanduser('~'), '.fawkes')
-    dictionaries = []
-    for extractor_name in feature_extractors_names:
-        fp = gzip.open(os.path.join(model_dir, "{}_emb.p.gz".format(extractor_name)), 'rb')
-        path2emb = pickle.load(fp)
-        fp.close()
-        dictionaries.append(path2emb)
-
-    merge_dict = {}
-    for k in dictionaries[0].keys():
-        cur_emb = [dic[k] for dic in dictionaries]
-        merge_dict[k] = np.concatenate(cur_emb)
-    return merge_dict
+def preload_embeddings(feature_extractors_names):
+    # maps the target index into this process; forked children share it
+    return load_embedding_index(feature_extractors_names)
 
 
 def extractor_ls_predict(feature_extractors_ls, X):
@@ -447,20 +503,9 @@ def extractor_ls_predict(feature_extractors_ls, X):
     return concated_feature_ls
 
 
-def pairwise_l2_distance(A, B):
-    BT = B.transpose()
-    vecProd = np.dot(A, BT)
-    SqA = A ** 2
-    sumSqA = np.matrix(np.sum(SqA, axis=1))
-    sumSqAEx = np.tile(sumSqA.transpose(), (1, vecProd.shape[1]))
-
-    SqB = B ** 2
-    sumSqB = np.sum(SqB, axis=1)
-    sumSqBEx = np.tile(sumSqB, (vecProd.shape[0], 1))
-    SqED = sumSqBEx + sumSqAEx - 2 * vecProd
-    SqED[SqED < 0] = 0.0
-    ED = np.sqrt(SqED)
-    return ED
+def pairwise_l2_distance(A, B, sumSqB=None):
+    # `sumSqB` are the squared row norms of B when they are known already
+    return np.sqrt(sq_distances(A, B, sumSqB))
 
 
 def calculate_dist_score(a, b, feature_extractors_ls, metric='l2'):
@@ -477,65 +522,66 @@ def calculate_dist_score(a, b, feature_extractors_ls, metric='l2'):
     return np.min(max_sum), paired_target_X
 
 
+def load_target_images(index, row):
+    target_data_id = index.ids[row]
+    with stage('load_targets', target=target_data_id):
+        # a view into the packed archive when there is one
+        target_images = index.target_images(row)
+        if target_images is None:
+            image_dir = os.path.join(os.path.expanduser('~'), '.fawkes', "target_data/{}".format(target_data_id))
+            image_paths = glob.glob(image_dir + "/*.jpg")
+
+            target_images = [image.img_to_array(image.load_img(cur_path)) for cur_path in
+                             image_paths]
+
+            target_images = np.array([resize(x, (224, 224)) for x in target_images])
+            target_images = preprocess(target_images, 'imagenet')
+    return target_images
+
+
+def select_target_labels(imgs, feature_extractors_ls, feature_extractors_names):
+    """Same as calling select_target_label on each face on its own, with one
+    forward pass and one distance computation for the whole batch. Every
+    face gets an independently drawn target; returns one target image per
+    face, stacked."""
+    with stage('extract_features', faces=len(imgs)):
+        original_feature_x = extractor_ls_predict(feature_extractors_ls, imgs)
+    with stage('load_embeddings'):
+        index = load_embedding_index(feature_extractors_names)
+    with stage('target_distance', candidates=len(index), faces=len(imgs)):
+        # per face, the 30 farthest candidates from farthest to closest
+        max_id_ls, _ = farthest_candidates(original_feature_x, index.embeddings, index.sq_norms, k=30)
+    # seeded from the OS, and not shared with other threads of the worker
+    rng = random.Random()
+
+    target_images = []
+    for face_ids in max_id_ls:
+        max_id = int(rng.choice(face_ids[10:30]))
+        target_images.append(rng.choice(list(load_target_images(index, max_id))))
+    return np.array(target_images)
+
+
 def select_target_label(imgs, feature_extractors_ls, feature_extractors_names, metric='l2'):
     model_dir = os.path.join(os.path.expanduser('~'), '.fawkes')
-    print('dog', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), flush=True)
-    original_feature_x = extractor_ls_predict(feature_extractors_ls, imgs)
-    print('cat', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), flush=True)
-    path2emb = load_embeddings(feature_extractors_names)
-    exclude_list = [1691, 19236, 20552, 9231, 18221, 8250, 18785, 6989, 17170,
-                    1704, 19394, 6058, 3327, 11885, 20375, 19150, 676, 11663,
-                    17261, 3527, 3956, 1973, 1197, 4859, 590, 13873, 928,
-                    14397, 4288, 3393, 6975, 16988, 1269, 323, 6409, 588,
-                    19738, 1845, 12123, 2714, 5318, 15325, 19268, 4650, 4714,
-                    3953, 6715, 6015, 12668, 13933, 14306, 2768, 20597, 4578,
-                    1278, 17549, 19355, 8882, 3276, 9148, 14517, 14915, 18209,
-                    3162, 8615, 18647, 749, 19259, 11490, 16046, 13259, 4429,
-                    10705, 12258, 13699, 4323, 15112, 14170, 3520, 17180, 5195,
-                    728, 2680, 13117, 20241, 15320, 8079, 2894, 11533, 10083,
-                    9628, 14944, 13124, 13316, 8006, 15353, 15261, 8865, 1213,
-                    1469, 20777, 9868, 10972, 9058, 18890, 13178, 13772, 15675,
-                    10572, 8771, 14211, 18781, 16347, 17985, 11456, 5849, 15709,
-                    20856, 2590, 15964, 8377, 5465, 16928, 13063, 19766, 19643,
-                    8651, 8517, 5985, 14817, 18926, 3791, 1864, 20061, 7697,
-                    13449, 19525, 13131, 421, 7629, 14689, 17521, 4509, 19374,
-                    17584, 11055, 11929, 17117, 7492, 14182, 409, 14294, 15033,
-                    10074, 9081, 7682, 19306, 3674, 945, 13211, 10933, 17953,
-                    12729, 8087, 20723, 5396, 14015, 20110, 15186, 6939, 239,
-                    2393, 17326, 13712, 9921, 7997, 6215, 14582, 864, 18906,
-                    9351, 9178, 3600, 18567, 8614, 19429, 286, 10042, 13030,
-                    7076, 3370, 15285, 7925, 10851, 5155, 14732, 12051, 11334,
-                    17035, 15476]
-    exclude_list = set(exclude_list)
-
-    items = list([(k, v) for k, v in path2emb.items() if k not in exclude_list])
-    paths = [p[0] for p in items]
-    embs = [p[1] for p in items]
-    embs = np.array(embs)
-    #print('rabbit', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), flush=True)
+    with stage('extract_features', faces=len(imgs)):
+        original_feature_x = extractor_ls_predict(feature_extractors_ls, imgs)
+    with stage('load_embeddings'):
+        index = load_embedding_index(feature_extractors_names)
     #np.set_printoptions(threshold=sys.maxsize)
-    pair_dist = pairwise_l2_distance(original_feature_x, embs)
-    pair_dist = np.array(pair_dist)
-    pair_dist_std = np.sort(pair_dist[0],axis=0)
-    #print('hog', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), flush=True)
-    max_sum = np.min(pair_dist, axis=0)
-    max_id_ls = np.argsort(max_sum)[::-1]
+    with stage('target_distance', candidates=len(index)):
+        # candidates ranked by their distance to the closest face, only the
+        # 30 farthest are needed
+        max_id_ls, _ = farthest_candidates(original_feature_x, index.embeddings, index.sq_norms, k=30,
+                                           reduce='min')
+        max_id_ls = max_id_ls[0]
     random.seed(datetime.datetime.now())
     max_id = random.choice(max_id_ls[10:30])
 
-    #print(pair_dist.shape, flush=True)
-
-    #print(max_sum.shape, flush=True)
-    #print(pair_dist_std[-200:-1], flush=True)
-    #print(max_sum[max_id],flush=True)
-
-    target_data_id = paths[int(max_id)]
+    target_data_id = index.ids[int(max_id)]
 
     image_dir = os.path.join(model_dir, "target_data/{}".format(target_data_id))
-    #print(np.sort(pair_dist, axis=0), flush=True)
     # if not os.path.exists(image_dir):
 
-    #print('frog', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), flush=True)
     #os.makedirs(os.path.join(model_dir, "target_data"), exist_ok=True)
     #os.makedirs(image_dir, exist_ok=True)
     #for i in range(10):
@@ -547,22 +593,14 @@ def select_target_label(imgs, feature_extractors_ls, feature_extractors_names, m
     #                 cache_dir=model_dir, cache_subdir='target_data/{}/'.format(target_data_id))
     #    except Exception:
     #        pass
-    #print('toad', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), flush=True)
-
-    image_paths = glob.glob(image_dir + "/*.jpg")
-
-    target_images = [image.img_to_array(image.load_img(cur_path)) for cur_path in
-                     image_paths]
 
-    target_images = np.array([resize(x, (224, 224)) for x in target_images])
-    target_images = preprocess(target_images, 'imagenet')
+    target_images = load_target_images(index, int(max_id))
 
     target_images = list(target_images)
     while len(target_images) < len(imgs):
         target_images += target_images
 
     target_images = random.sample(target_images, len(imgs))
-    print('iguana', datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'), flush=True)
     return np.array(target_images)
 
 
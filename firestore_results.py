@@ -0,0 +1,64 @@
+"""Result publishing for prod_worker: cloaked images go to S3 and their
+Firestore documents, with the users' counter decrements, go out in as few
+batched commits as Firestore allows. Kept apart from prod_worker so it can
+be used without loading the protector."""
+
+import collections
+import json
+from concurrent.futures import as_completed
+
+from google.cloud.firestore import Increment
+
+FIRESTORE_BATCH_LIMIT = 500
+
+
+def publish_results(uploader, firestore_db, messages, jobs, cloaked, cdn_url):
+    # upload every cloaked image of the batch at once, then fill the firestore
+    # batch as the uploads complete; uploaded images are served from `cdn_url`
+    futures = {}
+    new_messes = []
+    for mess, (_, s3_path) in zip(messages, jobs):
+        messy = json.loads(mess)
+        new_mess = dict(messy)
+        url_parts = messy["imageUrl"].split('/')
+        ul_s3_path = 'processed'+'/'+ url_parts[-1]
+        new_messes.append(new_mess)
+        if s3_path in cloaked:
+            futures[uploader.upload('trix', ul_s3_path, cloaked[s3_path])] = (new_mess, ul_s3_path)
+        else:
+            #image not processed with model
+            print("No cloaked image found, keeping original")
+            new_mess["unalteredImageUrl"] = new_mess["imageUrl"]
+
+    for future in as_completed(futures):
+        new_mess, ul_s3_path = futures[future]
+        try:
+            future.result()
+            new_mess["unalteredImageUrl"] = new_mess.pop("imageUrl")
+            new_mess["imageUrl"] = cdn_url + ul_s3_path
+        except Exception as e:
+            print("upload of {} failed, keeping original".format(ul_s3_path), e)
+            new_mess["unalteredImageUrl"] = new_mess["imageUrl"]
+
+    # one counter decrement per user, committed together with the result docs
+    decrements = collections.Counter(new_mess['uid'] for new_mess in new_messes)
+    writes = []
+    for uid, count in decrements.items():
+        user_ref = firestore_db.collection(u'users').document(uid)
+        writes.append(('update', user_ref, {u'unprocessedCount': Increment(-count)}))
+    for new_mess in new_messes:
+        new_ref = firestore_db.collection(u'trixpix').document()
+        writes.append(('set', new_ref, new_mess))
+    commit_writes(firestore_db, writes)
+
+
+def commit_writes(firestore_db, writes, limit=FIRESTORE_BATCH_LIMIT):
+    # firestore rejects batches with more than 500 writes, split if needed
+    for i in range(0, len(writes), limit):
+        batch = firestore_db.batch()
+        for op, ref, data in writes[i:i + limit]:
+            if op == 'update':
+                batch.update(ref, data)
+            else:
+                batch.set(ref, data)
+        batch.commit()
@@ -1,51 +1,36 @@
 import sys
 sys.path.append('/home/ubuntu/fawkes/fawkes')
 
+import argparse
+import collections
+import itertools
 from datetime import datetime
 import random
-import string
 import json
 import os
 import boto3
 import time
-import glob
-import shutil
-import multiprocessing
 import firebase_admin
 from firebase_admin import credentials, firestore
-from google.cloud.firestore import Increment
 from base64 import b64decode
 from protection_compute_frontloaded import Fawkes
 from utils import FaceNotFoundError
 from format_demo_output import format_demo_output
+from sqs_consumer import PrefetchingConsumer, VisibilityHeartbeat
+from s3_transfer import S3Downloader, S3Uploader, make_s3_client
+from worker_pipeline import Pipeline
+from adaptive_batcher import AdaptiveBatcher
+from cloak_cache import CloakCache, DiskStore
+from face_queue import FaceQueue
+from firestore_results import publish_results
+from fawkes.instrumentation import instrumentation, context, stage
 
 global NUM_MESSAGES
 NUM_MESSAGES = 3
 
-def get_random_string(length):
-    letters = string.ascii_lowercase
-    return ''.join(random.choice(letters) for i in range(length))
-
-
-def initialize():
-    session = boto3.session.Session(profile_name="do")
-    global client
-    client = session.client('s3', endpoint_url=S3_ENDPOINT_URL)
-
-# the work function of each process which will fetch something from s3
-def download(job):
-    bucket, key, filename = job
-    i = 0
-    while i < 10:
-        try:
-            client.download_file(bucket, key, filename)
-            break
-        except Exception as e:
-            print(e)
-            i += 1
-            time.sleep(5)
-
-def consume_messages():
+def consume_messages(num_messages=NUM_MESSAGES, heartbeat=None, visibility_timeout=30):
+    # with a heartbeat the messages are kept in flight until acked, otherwise
+    # they are deleted as soon as they are received
     print("consuming messages!")
     sqs = boto3.client('sqs', aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET, region_name="us-west-2")
     queue_url = SQS_QUEUE_URL
@@ -61,11 +46,11 @@ def consume_messages():
             AttributeNames=[
                 'SentTimestamp'
             ],
-            MaxNumberOfMessages=NUM_MESSAGES,
+            MaxNumberOfMessages=min(num_messages - len(message_bodies), 10),
             MessageAttributeNames=[
                 'All'
             ],
-            VisibilityTimeout=30,
+            VisibilityTimeout=visibility_timeout,
             WaitTimeSeconds=0
         )
 
@@ -81,98 +66,344 @@ def consume_messages():
             id_ctr += 1
 
         # max messages recieved!
-        if (len(message_bodies) == NUM_MESSAGES):
+        if (len(message_bodies) == num_messages):
             break
 
         #print(api_req)
 
-    if len(message_bodies) > 0:
+    receipts = [entry['ReceiptHandle'] for entry in receipt_entries]
+    if heartbeat is not None:
+        heartbeat.track(receipts)
+    elif len(message_bodies) > 0:
         del_response = sqs.delete_message_batch( QueueUrl=queue_url, Entries=receipt_entries)
         print(del_response)
-    return {"messages":message_bodies}
-
-
-if __name__ == "__main__":
-    #
-    random.seed(datetime.now())
-    protector = Fawkes("high_extract", "0", 1)
-    #firebase stuff
-    cred = credentials.Certificate("trix-ai-app-firebase-adminsdk-rxzfw-aabec76c1d.json")
-    firebase_admin.initialize_app(cred)
-    firestore_db = firestore.client()
-    while True:
-        content = consume_messages()
+    return {"messages":message_bodies, "receipts": receipts}
+
+
+def message_mode(messy, args):
+    # unknown or unlisted modes fall back to the default rather than
+    # building a new attack graph (or exiting, for 'ultra' without a GPU)
+    mode = messy.get("mode", args.mode)
+    return mode if mode in args.modes else args.mode
+
+
+def early_stopping(args):
+    return dict(plateau_window=args.plateau_window, target_bottlesim=args.target_bottlesim,
+                stop_at_budget=args.stop_at_budget)
+
+
+def build_pipeline(args, protector, consumer, heartbeat, downloader, uploader, firestore_db, batcher=None,
+                   caches=None):
+    # fetch -> decode+detect -> attack -> encode+upload, connected by bounded
+    # queues so the attack stage is never waiting on I/O in steady state.
+    # Messages stay in flight under `heartbeat` and are only deleted once
+    # their results are uploaded and committed.
+    # Each message may ask for its own protection mode; images are grouped
+    # by mode and every group runs on the attack graph cached for it.
+    # `caches` maps a mode to its CloakCache.
+    caches = caches or {}
+    batch_ids = itertools.count()
+
+    def fetch():
+        num_messages, batch_size = NUM_MESSAGES, None
+        if batcher is not None:
+            num_messages, batch_size = batcher.plan()
+        if consumer is not None:
+            # blocks on the prefetch buffer instead of sleeping
+            content = consumer.get_batch(num_messages, timeout=20)
+        else:
+            content = consume_messages(num_messages, heartbeat=heartbeat,
+                                       visibility_timeout=args.visibility_timeout)
         print(content)
         if len(content['messages']) == 0:
-            print("no messages in queue, waiting 10 seconds!")
-            time.sleep(10)
-            continue
-
-        jobs = []
-        dirname = get_random_string(12)
-        os.mkdir(dirname)
-        #dirname = "qyzijmbmshsu"
-        for mess in content["messages"]:
-            messy = json.loads(mess)
-            url_parts = messy["imageUrl"].split('/')
-            s3_path = url_parts[-2] + '/'+ url_parts[-1]
-            dl_path = dirname + '/'+ url_parts[-1]
-            jobs.append(('trix', s3_path, dl_path))
-
-        #download images
-        pool = multiprocessing.Pool(5, initialize)
-        pool.map(download, jobs)
-        pool.close()
-        pool.join()
-
-        image_paths = glob.glob(os.path.join(dirname, "*"))
-        file_ra = [path for path in image_paths if "_cloaked" not in path.split("/")[-1]]
-        print(file_ra)
-
+            if consumer is None:
+                print("no messages in queue, waiting 10 seconds!")
+                time.sleep(10)
+            return None
 
         try:
-            protector.run_protection(file_ra, mode="low", th=.01, sd=1e9, lr=2, max_step=1000, batch_size=1, format="png", separate_target=True, debug=False)
-        except Exception as inst:
-            if isinstance(inst, FaceNotFoundError):
+            jobs = []
+            modes = {}
+            for mess in content["messages"]:
+                messy = json.loads(mess)
+                url_parts = messy["imageUrl"].split('/')
+                s3_path = url_parts[-2] + '/'+ url_parts[-1]
+                jobs.append(('trix', s3_path))
+                modes[s3_path] = message_mode(messy, args)
+
+            # results already in the cache skip the protector entirely; the
+            # ETag check avoids even downloading the body
+            cached = {}
+            skip = None
+            if caches:
+                def skip(key, etag):
+                    hit = caches[modes[key]].lookup_etag(etag)
+                    if hit is not None:
+                        cached[key] = hit
+                    return hit is not None
+
+            #download images straight into memory
+            downloaded = downloader.download(jobs, skip=skip)
+        except Exception:
+            heartbeat.release(content["receipts"])
+            raise
+        images = {}
+        etags = {}
+        for (_, key), (etag, data) in zip(jobs, downloaded):
+            if key in cached or data is None:
+                continue
+            hit = caches[modes[key]].lookup(data) if caches else None
+            if hit is not None:
+                cached[key] = hit
+                continue
+            images[key] = data
+            etags[key] = etag
+        print(list(images.keys()), "cached:", list(cached.keys()))
+        return {"messages": content["messages"], "receipts": content["receipts"], "jobs": jobs, "images": images,
+                "etags": etags, "modes": modes, "cached": cached, "groups": [], "batch_size": batch_size,
+                "received_at": time.time(), "batch_id": next(batch_ids)}
+
+    def detect(item):
+        by_mode = collections.OrderedDict()
+        for key, data in item["images"].items():
+            by_mode.setdefault(item["modes"][key], {})[key] = data
+        for mode, images in by_mode.items():
+            try:
+                job = protector.prepare(images, separate_target=True)
+            except FaceNotFoundError:
                 print("no faces found!")
-                pass
-            else:
+                continue
+            except Exception as inst:
                 print("something went wrong!", inst)
+                continue
+            item["groups"].append({"mode": mode, "job": job, "protected": None})
+        return item
 
-
-        batch = firestore_db.batch()
-        #digital ocean stuff
-        session = boto3.session.Session(profile_name="do")
-        client = session.client('s3', endpoint_url=S3_ENDPOINT_URL)
-        for mess in content["messages"]:
-            messy = json.loads(mess)
-            new_mess = dict(messy)
-            url_parts = messy["imageUrl"].split('/')
-            ul_path = dirname + '/' + url_parts[-1][:-4] + '_low_cloaked.jpg'
-            ul_s3_path = 'processed'+'/'+ url_parts[-1]
-            #decrement = firestore.FieldValue.increment(-1)
-            user_ref = firestore_db.collection(u'users').document(messy['uid'])
-
+    def attack(item):
+        for group in item["groups"]:
             try:
-                user_ref.update({u'unprocessedCount': Increment(-1)})
-                client.upload_file(ul_path, 'trix', ul_s3_path)
-                new_mess["unalteredImageUrl"] = new_mess.pop("imageUrl")
-                new_mess["imageUrl"] = S3_CDN_URL + ul_s3_path
-            except FileNotFoundError as e:
-                #image not processed with model
-                print("No file to upload found, uploading original")
-                time.sleep(3)
-                new_mess["unalteredImageUrl"] = new_mess["imageUrl"]
-
-            new_ref = firestore_db.collection(u'trixpix').document()
-            batch.set(new_ref, new_mess)
-
-        batch.commit()
-        shutil.rmtree(dirname)
-
-
-
-
-
+                group["protected"] = protector.cloak(group["job"], batch_size=item["batch_size"],
+                                                     mode=group["mode"])
+                if batcher is not None and protector.last_attack is not None:
+                    batch_size, step_time, steps = protector.last_attack
+                    batcher.observe_attack(batch_size, step_time, steps,
+                                           len(group["job"].original_images), len(item["messages"]))
+            except Exception as inst:
+                print("something went wrong!", inst)
+        return item
+
+    face_queue = FaceQueue()
+    stages = {}
+
+    def faces_waiting(inbox):
+        with inbox.mutex:
+            waiting = list(inbox.queue)
+        return any(FaceQueue.count(item) for item in waiting)
+
+    def attack_packed(item):
+        # faces from every queued item go through one face queue and are cut
+        # into full attack batches, so a group photo costs its own faces
+        # instead of padding the batch it lands in; finished items move on
+        # as soon as their last face is cloaked
+        if face_queue.put(item) == 0:
+            # nothing to cloak, but faces held back earlier still need a batch
+            yield item
+        elif batcher is not None:
+            batcher.observe_faces(item["remaining"], len(item["messages"]))
+        batch_size = item["batch_size"] or protector.batch_size
+        while len(face_queue):
+            # top the batch up with the next detected item if it has faces
+            if len(face_queue) < batch_size and faces_waiting(stages["attack"].inbox):
+                return
+            mode, batch = face_queue.take(batch_size)
+            try:
+                faces, targets = face_queue.faces_of(batch)
+                packed = sorted(set(entry[0]["batch_id"] for entry in batch))
+                with context(batches=packed, faces=len(batch)), stage("worker_attack"):
+                    protected = protector.cloak_faces(faces, targets, batch_size=batch_size, mode=mode)
+                done = face_queue.finish(batch, protected, protector.last_iterations)
+                if batcher is not None and protector.last_attack is not None:
+                    batch_size_run, step_time, steps = protector.last_attack
+                    batcher.observe_attack(batch_size_run, step_time, steps, len(batch), 0)
+            except Exception as inst:
+                print("something went wrong!", inst)
+                done = face_queue.finish(batch)
+            for finished in done:
+                yield finished
+
+    def encode_upload(item):
+        cloaked = dict(item["cached"])
+        for group in item["groups"]:
+            if group["protected"] is None:
+                continue
+            results = protector.finish(group["job"], group["protected"], format="png")
+            if caches:
+                for key, data in results.items():
+                    caches[group["mode"]].put(item["images"][key], data, etag=item["etags"].get(key))
+            cloaked.update(results)
+        publish_results(uploader, firestore_db, item["messages"], item["jobs"], cloaked, S3_CDN_URL)
+        heartbeat.ack(item["receipts"])
+        if batcher is not None:
+            batcher.observe_latency(time.time() - item["received_at"])
+
+    def traced(name, fn):
+        # tag everything the protector times inside `fn` with the batch id
+        def run(item):
+            with context(batch=item["batch_id"], messages=len(item["messages"])), stage("worker_" + name):
+                return fn(item)
+        return run
+
+    def release(item):
+        # a stage failed on the batch: let SQS redeliver it rather than
+        # keeping it invisible under the heartbeat
+        heartbeat.release(item["receipts"])
+
+    def release_packed(item):
+        # the faces held back from earlier items go with the failed stage,
+        # release their messages along with the item's own
+        release(item)
+        for held in face_queue.drain():
+            if held is not item:
+                release(held)
+
+    pipeline = Pipeline(queue_size=args.queue_size)
+    pipeline.add_stage("fetch", fetch, concurrency=args.fetch_concurrency)
+    pipeline.add_stage("detect", traced("detect", detect), concurrency=args.detect_concurrency, on_error=release)
+    # the attack graph is shared, so more than one attack thread only helps
+    # once there are several protectors to run on
+    if args.pack_faces:
+        stages["attack"] = pipeline.add_stage("attack", attack_packed, concurrency=1, many=True,
+                                              on_error=release_packed)
+    else:
+        stages["attack"] = pipeline.add_stage("attack", traced("attack", attack), concurrency=1, on_error=release)
+    pipeline.add_stage("upload", traced("upload", encode_upload), concurrency=args.upload_stage_concurrency,
+                       on_error=release)
+    return pipeline
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--consumer', type=str, choices=['poll', 'prefetch'], default='poll',
+                        help="'poll' short-polls until NUM_MESSAGES arrive, 'prefetch' long-polls in the background")
+    parser.add_argument('--prefetch', type=int, default=2 * NUM_MESSAGES,
+                        help="number of messages to keep buffered in prefetch mode")
+    parser.add_argument('--sqs-endpoint-url', type=str, default=os.environ.get('SQS_ENDPOINT_URL'),
+                        help="override the SQS endpoint, e.g. a local ElasticMQ instance")
+    parser.add_argument('--visibility-timeout', type=int, default=30,
+                        help="seconds messages stay invisible between heartbeats")
+    parser.add_argument('--max-in-flight', type=int, default=1800,
+                        help="seconds after which a message is no longer kept invisible and SQS redelivers it")
+    parser.add_argument('--download-concurrency', type=int, default=5,
+                        help="number of threads sharing the S3 client for downloads")
+    parser.add_argument('--upload-concurrency', type=int, default=5,
+                        help="number of threads sharing the S3 client for uploads")
+    parser.add_argument('--queue-size', type=int, default=2,
+                        help="batches buffered between pipeline stages")
+    parser.add_argument('--fetch-concurrency', type=int, default=1)
+    parser.add_argument('--detect-concurrency', type=int, default=1)
+    parser.add_argument('--upload-stage-concurrency', type=int, default=2)
+    parser.add_argument('--adaptive', action='store_true',
+                        help="size message and attack batches from queue depth and measured attack speed")
+    parser.add_argument('--latency-target', type=float, default=30.0,
+                        help="p95 seconds from receive to publish the adaptive batcher aims for")
+    parser.add_argument('--max-messages', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="attack batch size when the adaptive batcher is off")
+    parser.add_argument('--attack-batch-sizes', type=str, default="1,2,4",
+                        help="comma separated attack batch sizes the adaptive batcher may use")
+    parser.add_argument('--pack-faces', action='store_true',
+                        help="pack faces from all detected messages into full attack batches")
+    parser.add_argument('--batch-buckets', type=lambda s: [int(b) for b in s.split(',')], default=None,
+                        help="comma separated attack graph batch sizes built at startup, every attack runs on "
+                             "the smallest that fits its faces; with --artifact they must be compiled into it")
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help="directory for the content-addressed cloak cache, disabled when unset")
+    parser.add_argument('--cache-max-gb', type=float, default=2.0)
+    parser.add_argument('--mode', type=str, default='low',
+                        help="protection mode for messages that do not ask for one")
+    parser.add_argument('--modes', type=lambda s: s.split(','), default=None,
+                        help="comma separated modes messages may ask for, their attack graphs are built at startup")
+    parser.add_argument('--steps-per-run', type=int, default=1,
+                        help="attack steps per session call, >1 runs them in an in-graph loop")
+    parser.add_argument('--plateau-window', type=int, default=0,
+                        help="stop a face once its similarity has not improved for this many steps, 0 disables")
+    parser.add_argument('--target-bottlesim', type=float, default=0.0,
+                        help="stop a face once its feature distance to the target drops to this, 0 disables")
+    parser.add_argument('--stop-at-budget', action='store_true',
+                        help="stop a face once its perturbation reaches the mode's DSSIM threshold")
+    parser.add_argument('--optimizer', type=str, choices=['adadelta', 'adam', 'sign'], default='adadelta',
+                        help="attack optimizer, the modes are tuned for adadelta; compare with fawkes/optimizers.py")
+    parser.add_argument('--optimizer-lr', type=float, default=None,
+                        help="learning rate for a non-adadelta optimizer, defaults to its own")
+    parser.add_argument('--refill', action='store_true',
+                        help="hand a face's attack batch slot to the next face as soon as it is done")
+    parser.add_argument('--artifact', type=str, default=None,
+                        help="compiled graph directory from fawkes/artifacts.py, for a fast cold start")
+    parser.add_argument('--stats-interval', type=int, default=60,
+                        help="seconds between pipeline utilization reports")
+    parser.add_argument('--metrics-jsonl', type=str, default=None,
+                        help="append one JSON record per timed stage to this file")
+    parser.add_argument('--metrics-prom-file', type=str, default=None,
+                        help="periodically write stage latency histograms here in Prometheus text format")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve stage latency histograms for Prometheus on this port")
+    args = parser.parse_args(argv[1:])
+    if args.modes is None:
+        args.modes = [args.mode]
+    elif args.mode not in args.modes:
+        args.modes.append(args.mode)
+    return args
+
+
+def run_worker(args, protector):
+    instrumentation.configure(jsonl_path=args.metrics_jsonl, prometheus_path=args.metrics_prom_file,
+                              port=args.metrics_port, interval=args.stats_interval)
+    #firebase stuff
+    cred = credentials.Certificate("trix-ai-app-firebase-adminsdk-rxzfw-aabec76c1d.json")
+    firebase_admin.initialize_app(cred)
+    firestore_db = firestore.client()
+    #digital ocean stuff
+    client = make_s3_client(S3_ENDPOINT_URL,
+                            max_pool_connections=max(10, args.download_concurrency + args.upload_concurrency))
+    downloader = S3Downloader(client, concurrency=args.download_concurrency)
+    uploader = S3Uploader(client, concurrency=args.upload_concurrency)
+    sqs = boto3.client('sqs', aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET,
+                       region_name="us-west-2", endpoint_url=args.sqs_endpoint_url)
+    consumer = None
+    if args.consumer == 'prefetch':
+        consumer = PrefetchingConsumer(SQS_QUEUE_URL, sqs=sqs, visibility_timeout=args.visibility_timeout,
+                                       prefetch=max(args.prefetch, args.max_messages if args.adaptive else 0),
+                                       max_age=args.max_in_flight).start()
+        heartbeat = consumer.heartbeat
+    else:
+        heartbeat = VisibilityHeartbeat(sqs, SQS_QUEUE_URL, visibility_timeout=args.visibility_timeout,
+                                        max_age=args.max_in_flight).start()
+
+    batcher = None
+    if args.adaptive:
+        batcher = AdaptiveBatcher(sqs, SQS_QUEUE_URL, latency_target=args.latency_target,
+                                  max_messages=args.max_messages,
+                                  batch_sizes=[int(b) for b in args.attack_batch_sizes.split(',')])
+
+    caches = {}
+    reporters = {}
+    if args.cache_dir:
+        # outputs depend on the protection settings, namespace the keys by them
+        store = DiskStore(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+        for mode in args.modes:
+            caches[mode] = CloakCache(store, namespace=protector.param_string(mode))
+            reporters["cache " + mode] = caches[mode].stats
+
+    pipeline = build_pipeline(args, protector, consumer, heartbeat, downloader, uploader, firestore_db,
+                              batcher=batcher, caches=caches).start()
+    pipeline.report_forever(args.stats_interval, reporters=reporters)
 
 
+if __name__ == "__main__":
+    #
+    args = parse_args(sys.argv)
+    random.seed(datetime.now())
+    protector = Fawkes("high_extract", "0", args.batch_size, artifact=args.artifact, modes=args.modes,
+                       steps_per_run=args.steps_per_run, early_stopping=early_stopping(args), refill=args.refill,
+                       batch_buckets=args.batch_buckets, optimizer=args.optimizer, optimizer_lr=args.optimizer_lr)
+    run_worker(args, protector)
@@ -0,0 +1,97 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from fawkes.instrumentation import instrumentation
+
+
+def make_s3_client(endpoint_url, profile_name="do", max_pool_connections=10):
+    # boto3 clients are thread safe, so one client (and its connection pool)
+    # is shared by every transfer thread
+    session = boto3.session.Session(profile_name=profile_name)
+    return session.client('s3', endpoint_url=endpoint_url,
+                          config=Config(max_pool_connections=max_pool_connections))
+
+
+class S3Downloader(object):
+    """Long-lived threaded downloader that reuses a single pooled S3 client
+    across batches and times each object as the `s3_download` stage."""
+
+    def __init__(self, client, concurrency=5, retries=10, retry_wait=5):
+        self.client = client
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="s3-download")
+
+    def _download(self, job, skip=None):
+        bucket, key = job
+        start = time.perf_counter()
+        etag, data = None, None
+        skipped = False
+        i = 0
+        while i < self.retries:
+            try:
+                # one round trip either way: the ETag arrives with the headers,
+                # and a cached object's body is closed before it is read
+                response = self.client.get_object(Bucket=bucket, Key=key)
+                etag = response.get('ETag')
+                if skip is not None and skip(key, etag):
+                    response['Body'].close()
+                    skipped = True
+                    break
+                data = response['Body'].read()
+                break
+            except Exception as e:
+                print(e)
+                i += 1
+                time.sleep(self.retry_wait)
+        instrumentation.observe('s3_download', time.perf_counter() - start, key=key, skipped=skipped,
+                                failed=data is None and not skipped)
+        return etag, data
+
+    def download(self, jobs, skip=None):
+        """Download `(bucket, key)` jobs concurrently into memory and return
+        `(etag, bytes)` pairs in job order. `bytes` is None where every retry
+        failed or where `skip(key, etag)` returned True."""
+        return list(self.executor.map(lambda job: self._download(job, skip), jobs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class S3Uploader(object):
+    """Threaded uploader sharing the same pooled client; `upload` returns a
+    future so a whole batch can be in flight at once. Objects are timed as
+    the `s3_upload` stage."""
+
+    def __init__(self, client, concurrency=5, retries=3, retry_wait=1):
+        self.client = client
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="s3-upload")
+
+    def _upload(self, bucket, key, data):
+        start = time.perf_counter()
+        i = 0
+        while True:
+            try:
+                self.client.upload_fileobj(io.BytesIO(data), bucket, key)
+                break
+            except Exception as e:
+                i += 1
+                if i >= self.retries:
+                    raise
+                print(e)
+                time.sleep(self.retry_wait)
+        instrumentation.observe('s3_upload', time.perf_counter() - start, key=key)
+        return key
+
+    def upload(self, bucket, key, data):
+        return self.executor.submit(self._upload, bucket, key, data)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
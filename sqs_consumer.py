@@ -0,0 +1,214 @@
+import json
+import queue
+import threading
+import time
+
+import boto3
+
+
+def _chunks(items, size=10):
+    # SQS batch calls take at most 10 entries
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class VisibilityHeartbeat(object):
+    """Keeps received messages invisible while they are being worked on.
+
+    Messages are `track`ed when received; a background thread keeps pushing
+    their visibility timeout out, and they are deleted only when `ack`ed after
+    their results are committed. `release` hands them back to the queue
+    right away, and a crashed worker simply stops extending, so SQS
+    redelivers the work instead of losing it. With `max_age`, messages
+    tracked for longer than that many seconds stop being extended too, so
+    one dropped by a bug is not kept invisible forever.
+    """
+
+    def __init__(self, sqs, queue_url, visibility_timeout=30, interval=None, max_age=None):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval or max(1, visibility_timeout // 3)
+        self.max_age = max_age
+        self.in_flight = set()
+        self.tracked_at = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._beat_forever, name="sqs-heartbeat", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def track(self, receipts):
+        now = time.time()
+        with self._lock:
+            self.in_flight.update(receipts)
+            for receipt in receipts:
+                self.tracked_at.setdefault(receipt, now)
+
+    def _forget(self, receipts):
+        with self._lock:
+            self.in_flight.difference_update(receipts)
+            for receipt in receipts:
+                self.tracked_at.pop(receipt, None)
+
+    def _expire(self, now=None):
+        """Stop extending messages older than `max_age`; returns them."""
+        if self.max_age is None:
+            return []
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [r for r in self.in_flight if now - self.tracked_at.get(r, now) > self.max_age]
+        if expired:
+            print("giving up on {} messages in flight for over {}s".format(len(expired), self.max_age))
+            self._forget(expired)
+        return expired
+
+    def _change_visibility(self, receipts, timeout):
+        for chunk in _chunks(list(receipts)):
+            entries = [{'Id': str(i), 'ReceiptHandle': r, 'VisibilityTimeout': timeout}
+                       for i, r in enumerate(chunk)]
+            response = self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            for failed in response.get('Failed', []):
+                # usually the message was already deleted or its handle expired
+                print("could not extend visibility:", failed)
+                self._forget([chunk[int(failed['Id'])]])
+
+    def _beat_forever(self):
+        while not self._stop.wait(self.interval):
+            self._expire()
+            with self._lock:
+                receipts = list(self.in_flight)
+            if not receipts:
+                continue
+            try:
+                self._change_visibility(receipts, self.visibility_timeout)
+            except Exception as e:
+                print("visibility heartbeat failed:", e)
+
+    def ack(self, receipts):
+        """Delete messages whose results have been committed."""
+        self._forget(receipts)
+        for chunk in _chunks(list(receipts)):
+            entries = [{'Id': str(i), 'ReceiptHandle': r} for i, r in enumerate(chunk)]
+            del_response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            print(del_response)
+
+    def release(self, receipts):
+        """Stop extending messages and make them visible again for a retry."""
+        self._forget(receipts)
+        try:
+            self._change_visibility(receipts, 0)
+        except Exception as e:
+            print("could not release messages:", e)
+
+
+class PrefetchingConsumer(object):
+    """Long-polls an SQS queue from a background thread and keeps a bounded
+    buffer of decoded message bodies ready for the next batch. Buffered and
+    handed-out messages stay in flight under `heartbeat` until acked.
+
+    Pass `endpoint_url` (or a ready-made `sqs` client) to point it at a local
+    SQS stand-in such as ElasticMQ or localstack.
+    """
+
+    def __init__(self, queue_url, sqs=None, endpoint_url=None, region_name="us-west-2",
+                 aws_access_key_id=None, aws_secret_access_key=None,
+                 prefetch=10, wait_time=20, visibility_timeout=30, max_age=None):
+        if sqs is None:
+            sqs = boto3.client('sqs', aws_access_key_id=aws_access_key_id,
+                               aws_secret_access_key=aws_secret_access_key,
+                               region_name=region_name, endpoint_url=endpoint_url)
+        self.sqs = sqs
+        self.queue_url = queue_url
+        # SQS caps long polls at 20 seconds and receives at 10 messages
+        self.wait_time = min(wait_time, 20)
+        self.visibility_timeout = visibility_timeout
+        self.buffer = queue.Queue(maxsize=prefetch)
+        self.heartbeat = VisibilityHeartbeat(sqs, queue_url, visibility_timeout=visibility_timeout,
+                                             max_age=max_age)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.heartbeat.start()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._poll_forever, name="sqs-prefetch", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.heartbeat.stop(timeout)
+
+    def ack(self, receipts):
+        self.heartbeat.ack(receipts)
+
+    def release(self, receipts):
+        self.heartbeat.release(receipts)
+
+    def _free_slots(self):
+        return self.buffer.maxsize - self.buffer.qsize()
+
+    def _poll_forever(self):
+        while not self._stop.is_set():
+            free = self._free_slots()
+            if free <= 0:
+                # buffer is full, wait for the protector to drain it
+                time.sleep(0.1)
+                continue
+            try:
+                self._poll_once(min(free, 10))
+            except Exception as e:
+                print("sqs receive failed:", e)
+                self._stop.wait(5)
+
+    def _poll_once(self, max_messages):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            AttributeNames=[
+                'SentTimestamp'
+            ],
+            MaxNumberOfMessages=max_messages,
+            MessageAttributeNames=[
+                'All'
+            ],
+            VisibilityTimeout=self.visibility_timeout,
+            WaitTimeSeconds=self.wait_time
+        )
+        messages = response.get('Messages', [])
+        if not messages:
+            return 0
+
+        self.heartbeat.track([mess['ReceiptHandle'] for mess in messages])
+        for mess in messages:
+            self.buffer.put((json.loads(mess["Body"]), mess['ReceiptHandle']))
+        return len(messages)
+
+    def get_batch(self, max_messages, timeout=None):
+        """Block until at least one message is buffered (or `timeout` passes),
+        then return up to `max_messages` without waiting for more. The
+        returned receipts must be passed to `ack` or `release`."""
+        entries = []
+        try:
+            entries.append(self.buffer.get(timeout=timeout))
+        except queue.Empty:
+            return {"messages": [], "receipts": []}
+        while len(entries) < max_messages:
+            try:
+                entries.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+        return {"messages": [body for body, _ in entries], "receipts": [r for _, r in entries]}
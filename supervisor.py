@@ -0,0 +1,97 @@
+import sys
+sys.path.append('/home/ubuntu/fawkes/fawkes')
+
+import argparse
+import multiprocessing
+import os
+import random
+import signal
+import time
+
+import numpy as np
+from protection_compute_frontloaded import Fawkes, preload_models
+import prod_worker
+
+# filled in by the parent before forking so children inherit the pages
+# instead of each re-reading and unpickling the model files
+preloaded = None
+
+
+def split_cpus(nb_workers):
+    cpus = sorted(os.sched_getaffinity(0))
+    if nb_workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(nb_workers)]
+    return [[int(c) for c in chunk] for chunk in np.array_split(cpus, nb_workers)]
+
+
+def worker_main(index, cpus, args, worker_argv):
+    os.sched_setaffinity(0, cpus)
+    # TF is already loaded by the parent, so thread counts only take effect
+    # through the session config Fawkes builds, not through the environment
+    threads = args.threads_per_worker or len(cpus)
+    # forked children start with the parent's random state
+    random.seed(time.time() + index)
+    np.random.seed((int(time.time()) + index) % (2 ** 32))
+    print("worker {} (pid {}) on cpus {} with {} TF threads".format(index, os.getpid(), cpus, threads))
+
+    worker_args = prod_worker.parse_args(worker_argv)
+    protector = Fawkes(args.feature_extractor, args.gpu, worker_args.batch_size, preloaded=preloaded,
+                       intra_op_threads=threads, inter_op_threads=1, artifact=args.artifact,
+                       modes=worker_args.modes, steps_per_run=worker_args.steps_per_run,
+                       early_stopping=prod_worker.early_stopping(worker_args), refill=worker_args.refill,
+                       batch_buckets=worker_args.batch_buckets, optimizer=worker_args.optimizer,
+                       optimizer_lr=worker_args.optimizer_lr)
+    prod_worker.run_worker(worker_args, protector)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="fork N prod_worker processes sharing preloaded models; "
+                                                 "unrecognized arguments are passed on to each worker")
+    parser.add_argument('--workers', type=int, default=max(1, os.cpu_count() // 4))
+    parser.add_argument('--threads-per-worker', type=int, default=0,
+                        help="TF intra-op threads per worker, defaults to the worker's share of cores")
+    parser.add_argument('--feature-extractor', type=str, default="high_extract")
+    parser.add_argument('--gpu', type=str, default="0")
+    parser.add_argument('--artifact', type=str, default=None,
+                        help="compiled graph directory; workers import it instead of using preloaded weights")
+    return parser.parse_known_args(argv[1:])
+
+
+def main(argv):
+    global preloaded
+    args, worker_args = parse_args(argv)
+    worker_argv = [argv[0]] + worker_args
+
+    if args.artifact is None:
+        start = time.time()
+        preloaded = preload_models(args.feature_extractor)
+        print("preloaded models in {:.1f}s".format(time.time() - start))
+
+    ctx = multiprocessing.get_context('fork')
+    cpu_sets = split_cpus(args.workers)
+    workers = [None] * args.workers
+
+    def shutdown(signum, frame):
+        for p in workers:
+            if p is not None and p.is_alive():
+                p.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        for i in range(args.workers):
+            p = workers[i]
+            if p is not None and p.is_alive():
+                continue
+            if p is not None:
+                print("worker {} exited with {}, restarting".format(i, p.exitcode))
+            p = ctx.Process(target=worker_main, args=(i, cpu_sets[i], args, worker_argv), daemon=False)
+            p.start()
+            workers[i] = p
+        time.sleep(5)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
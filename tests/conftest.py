@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the worker modules are imported from the repository root, as prod_worker does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
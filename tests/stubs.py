@@ -0,0 +1,54 @@
+import json
+
+
+class StubSQS(object):
+    """In-memory stand-in for the boto3 SQS client calls the worker makes."""
+
+    def __init__(self, bodies=(), failed_visibility=()):
+        self.messages = [{"Body": json.dumps(body), "ReceiptHandle": "r{}".format(i)}
+                         for i, body in enumerate(bodies)]
+        self.failed_visibility = set(failed_visibility)
+        self.visibility = []
+        self.deleted = []
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        taken, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return {"Messages": taken} if taken else {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        failed = []
+        for entry in Entries:
+            if entry['ReceiptHandle'] in self.failed_visibility:
+                failed.append({"Id": entry['Id']})
+            else:
+                self.visibility.append((entry['ReceiptHandle'], entry['VisibilityTimeout']))
+        return {"Successful": [], "Failed": failed}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.extend(entry['ReceiptHandle'] for entry in Entries)
+        return {"Successful": [{"Id": entry['Id']} for entry in Entries]}
+
+
+def pooled_features(x):
+    """Feature extractor stand-in for attack graph tests: the 224x224 input
+    average-pooled to 8x8."""
+    import tensorflow as tf
+    pooled = tf.nn.avg_pool(x, ksize=[1, 28, 28, 1], strides=[1, 28, 28, 1], padding='VALID')
+    return tf.reshape(pooled, [-1, 8 * 8 * 3])
+
+
+def random_faces(nb_faces, seed=0):
+    """Preprocessed 224x224 faces with pixels well inside 0-255."""
+    import numpy as np
+    from fawkes.utils import preprocess
+    rng = np.random.RandomState(seed)
+    return preprocess(rng.uniform(20, 235, (nb_faces, 224, 224, 3)).astype(np.float32), 'imagenet')
+
+
+def make_attack(sess, **kwargs):
+    """A small FawkesMaskGeneration over pooled_features."""
+    from fawkes.differentiator import FawkesMaskGeneration
+    settings = dict(batch_size=2, learning_rate=10.0, max_iterations=6, l_threshold=0.01, min_steps=1,
+                    verbose=1)
+    settings.update(kwargs)
+    return FawkesMaskGeneration(sess, [pooled_features], **settings)
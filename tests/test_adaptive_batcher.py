@@ -0,0 +1,56 @@
+from adaptive_batcher import AdaptiveBatcher
+
+
+class StubQueue(object):
+    def __init__(self, depth):
+        self.depth = depth
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        return {"Attributes": {"ApproximateNumberOfMessages": str(self.depth)}}
+
+
+def batcher(depth, **kwargs):
+    kwargs.setdefault("latency_target", 120.0)
+    return AdaptiveBatcher(StubQueue(depth), "queue", max_messages=8, batch_sizes=(1, 2, 4), **kwargs)
+
+
+def test_unmeasured_sizes_are_probed_once():
+    b = batcher(depth=8)
+    assert b.plan() == (1, 1)
+    b.observe_attack(1, 0.5, 45, 1, 1)
+    assert b.plan() == (2, 2)
+    assert b.plan() == (4, 4)
+    # nothing left to probe, 2 and 4 are never handed out blind again
+    assert b.probed == {1, 2, 4}
+
+
+def test_probe_waits_for_enough_backlog():
+    b = batcher(depth=1)
+    b.observe_attack(1, 0.5, 45, 1, 1)
+    assert b.plan() == (1, 1)
+
+
+def test_plan_picks_a_larger_batch_when_it_is_faster():
+    b = batcher(depth=8)
+    b.probed.update([1, 2, 4])
+    b.observe_attack(1, 0.5, 45, 1, 1)
+    b.observe_attack(2, 0.6, 45, 2, 2)
+    b.observe_attack(4, 0.8, 45, 4, 4)
+    nb_messages, batch_size = b.plan()
+    assert batch_size == 4
+    assert nb_messages > 1
+
+
+def test_plan_stays_at_one_when_batching_does_not_help():
+    b = batcher(depth=8)
+    b.probed.update([1, 2, 4])
+    b.observe_attack(1, 0.5, 45, 1, 1)
+    b.observe_attack(2, 1.0, 45, 2, 2)
+    b.observe_attack(4, 2.0, 45, 4, 4)
+    assert b.plan()[1] == 1
+
+
+def test_prior_is_sublinear():
+    b = batcher(depth=8)
+    b.observe_attack(1, 0.5, 45, 1, 1)
+    assert b.step_time(4) < 4 * b.step_time(1)
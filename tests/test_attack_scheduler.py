@@ -0,0 +1,77 @@
+import numpy as np
+
+from fawkes.attack_scheduler import SlotScheduler
+
+
+class StubSession(object):
+    """Plays the refill graph: a face is a batch of one image whose first
+    pixel is the number of steps it needs before it stops."""
+
+    def __init__(self, p):
+        self.p = p
+        self.slots = {}
+        self.steps = np.zeros(p.batch_size, dtype=np.int64)
+        self.loads = []
+        self.retired = []
+
+    def run(self, fetches, feed_dict=None):
+        p, feed = self.p, feed_dict
+        if fetches is p.load_slots:
+            self.loads.append(list(feed[p.slot_holder]))
+            for slot, img in zip(feed[p.slot_holder], feed[p.refill_simg_tanh]):
+                self.slots[slot] = img
+                self.steps[slot] = 0
+        elif fetches is p.retire:
+            self.retired.extend(feed[p.slot_holder])
+        elif fetches == [p.train, p.active]:
+            active = np.zeros(p.batch_size, dtype=bool)
+            for slot, img in self.slots.items():
+                self.steps[slot] += 1
+                active[slot] = self.steps[slot] < img.flat[0]
+            return None, active
+        elif fetches == [p.slot_best_adv, p.slot_iterations]:
+            slots = feed[p.slot_holder]
+            return np.array([self.slots[slot] for slot in slots]), self.steps[slots]
+
+
+class StubProtector(object):
+    MIMIC_IMG = True
+    MAX_ITERATIONS = 4
+    batch_size = 2
+    input_shape = (2, 1, 1, 1)
+    bottleneck_shape = (2, 1, 1, 1)
+    initial_const = 1.0
+    learning_rate = 1.0
+    limit_dist = False
+
+    def __init__(self):
+        for handle in ('init', 'setup', 'assign_simg_tanh', 'assign_const', 'assign_mask', 'assign_weights',
+                       'assign_modifier', 'assign_timg_tanh', 'slot_holder', 'load_slots', 'refill_simg_tanh',
+                       'refill_timg_tanh', 'refill_bottleneck', 'refill_floor', 'train', 'active',
+                       'learning_rate_holder', 'decay_every_holder', 'slot_best_adv', 'slot_iterations',
+                       'retire'):
+            setattr(self, handle, handle)
+        self.sess = StubSession(self)
+
+    def preprocess_arctanh(self, imgs):
+        return imgs
+
+    def clipping(self, imgs):
+        return imgs
+
+
+def test_finished_slots_are_refilled_right_away():
+    p = StubProtector()
+    needs = [1, 3, 2, 5, 1]
+    faces = np.array(needs, dtype=np.float32).reshape(-1, 1, 1, 1)
+    cloaked = SlotScheduler(p).attack(faces, faces)
+
+    # results come back in face order, whatever slot they ran in
+    np.testing.assert_array_equal(cloaked.ravel(), needs)
+    # the face needing 5 steps is cut off at MAX_ITERATIONS
+    assert p.last_iterations == [1, 3, 2, 4, 1]
+    assert p.sess.loads == [[0, 1], [0], [0, 1]]
+    # slots freed once the queue is empty are masked off
+    assert p.sess.retired == [1, 0]
+    # 7 steps for 3 batches' worth of faces
+    assert p.last_steps == 3
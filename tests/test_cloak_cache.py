@@ -0,0 +1,39 @@
+from cloak_cache import CloakCache, DiskStore
+
+
+def test_disk_store_evicts_least_recently_used(tmp_path):
+    store = DiskStore(str(tmp_path), max_bytes=10)
+    store.put("a", b"1234")
+    store.put("b", b"1234")
+    assert store.get("a") == b"1234"
+    store.put("c", b"1234")
+    assert store.get("b") is None
+    assert store.get("a") == b"1234"
+    assert store.total_bytes == 8
+    assert store.evictions == 1
+
+
+def test_disk_store_reloads_entries(tmp_path):
+    DiskStore(str(tmp_path)).put("a", b"xyz")
+    store = DiskStore(str(tmp_path))
+    assert store.get("a") == b"xyz"
+    assert store.total_bytes == 3
+
+
+def test_cloak_cache_hits_by_content_and_etag(tmp_path):
+    store = DiskStore(str(tmp_path))
+    cache = CloakCache(store, namespace="low")
+    assert cache.lookup(b"image") is None
+    cache.put(b"image", b"cloaked", etag='"abc"')
+    assert cache.lookup(b"image") == b"cloaked"
+    assert cache.lookup_etag('"abc"') == b"cloaked"
+    assert cache.lookup_etag('"other"') is None
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["etag_hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_namespaces_do_not_collide(tmp_path):
+    store = DiskStore(str(tmp_path))
+    CloakCache(store, namespace="low").put(b"image", b"low")
+    assert CloakCache(store, namespace="high").lookup(b"image") is None
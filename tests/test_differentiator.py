@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("keras")
+
+from stubs import make_attack, pooled_features, random_faces
+
+
+def test_single_step_on_a_fresh_session():
+    # nothing but the attack's own init and setup touches its variables here
+    with tf.Graph().as_default(), tf.Session() as sess:
+        attack = make_attack(sess, max_iterations=5)
+        source = random_faces(1)
+        cloaked = attack.attack(source, random_faces(1, seed=1))
+        assert cloaked.shape == source.shape
+        assert attack.last_iterations == [5]
+        # the padding slot is never compared, the face improved at least once
+        best = sess.run(attack.best_bottlesim)
+        assert np.isfinite(best[0]) and np.isinf(best[1])
+
+
+def test_target_features_are_computed_once_per_batch():
+    with tf.Graph().as_default(), tf.Session() as sess:
+        attack = make_attack(sess)
+        source, target = random_faces(2), random_faces(2, seed=1)
+        attack.attack(source, target)
+        features = pooled_features(tf.constant(np.concatenate([source, target]), dtype=tf.float32))
+        original, wanted = np.split(sess.run(features), 2)
+        bottleneck_t = sess.run(attack.bottleneck_targets[0])
+        np.testing.assert_allclose(bottleneck_t, original + 2.0 * (wanted - original), rtol=1e-3, atol=1e-2)
+        # the steps read the stored target instead of recomputing it
+        sess.run(attack.train, {attack.learning_rate_holder: 1.0})
+        np.testing.assert_array_equal(sess.run(attack.bottleneck_targets[0]), bottleneck_t)
+
+
+def test_fused_loop_matches_the_per_step_loop():
+    source, target = random_faces(2), random_faces(2, seed=1)
+    results = []
+    for steps_per_run in (1, 4):
+        with tf.Graph().as_default(), tf.Session() as sess:
+            attack = make_attack(sess, steps_per_run=steps_per_run)
+            assert (attack.fused_train is not None) == (steps_per_run > 1)
+            results.append((attack.attack(source, target), attack.last_iterations, attack.last_steps))
+    (per_step, per_step_iterations, per_step_steps), (fused, fused_iterations, fused_steps) = results
+    assert per_step_iterations == fused_iterations == [6, 6]
+    assert per_step_steps == fused_steps == 6
+    np.testing.assert_allclose(fused, per_step, rtol=1e-4, atol=1e-3)
+
+
+def test_images_stopped_early_keep_their_last_step():
+    with tf.Graph().as_default(), tf.Session() as sess:
+        # the first step never improves, so both faces stop right after it
+        attack = make_attack(sess, plateau_window=1)
+        source = random_faces(2)
+        cloaked = attack.attack(source, random_faces(2, seed=1))
+        assert attack.last_iterations == [1, 1]
+        assert np.all(np.isfinite(sess.run(attack.best_bottlesim)))
+        # the stepped face, not the zeros best_adv starts from
+        np.testing.assert_allclose(cloaked, source, atol=5.0)
+
+
+def test_refilled_slots_match_faces_attacked_alone():
+    source, target = random_faces(3), random_faces(3, seed=1)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        attack = make_attack(sess, refill=True)
+        refilled = attack.attack(source, target)
+        assert attack.last_iterations == [6, 6, 6]
+    alone = []
+    for i in range(3):
+        with tf.Graph().as_default(), tf.Session() as sess:
+            alone.append(make_attack(sess, batch_size=1).attack(source[i:i + 1], target[i:i + 1])[0])
+    np.testing.assert_allclose(refilled, np.array(alone), rtol=1e-3, atol=1e-2)
+
+
+def test_each_face_gets_its_own_target():
+    source, target = random_faces(3), random_faces(3, seed=1)
+    targets = []
+    for rows in ([0, 1], [0, 2]):
+        with tf.Graph().as_default(), tf.Session() as sess:
+            attack = make_attack(sess, max_iterations=5)
+            attack.attack(source[rows], target[rows])
+            targets.append(sess.run(attack.bottleneck_targets[0])[0])
+    # the first face's target does not depend on the face next to it
+    np.testing.assert_allclose(targets[0], targets[1], rtol=1e-5, atol=1e-5)
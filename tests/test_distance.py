@@ -0,0 +1,28 @@
+import numpy as np
+
+from fawkes.distance import farthest_candidates, sq_distances
+
+
+def test_sq_distances_match_direct_computation():
+    rng = np.random.RandomState(0)
+    A, B = rng.randn(3, 16).astype(np.float32), rng.randn(50, 16).astype(np.float32)
+    expected = ((A[:, None, :] - B[None, :, :]) ** 2).sum(-1)
+    np.testing.assert_allclose(sq_distances(A, B, chunk_size=7), expected, rtol=1e-4, atol=1e-4)
+
+
+def test_farthest_candidates_sorted_farthest_first():
+    rng = np.random.RandomState(1)
+    A, B = rng.randn(2, 8).astype(np.float32), rng.randn(40, 8).astype(np.float32)
+    d = np.sqrt(((A[:, None, :] - B[None, :, :]) ** 2).sum(-1))
+    idx, dist = farthest_candidates(A, B, k=5, chunk_size=9)
+    np.testing.assert_array_equal(idx, np.argsort(-d, axis=1)[:, :5])
+    np.testing.assert_allclose(dist, -np.sort(-d, axis=1)[:, :5], rtol=1e-4)
+
+
+def test_reduce_min_ranks_by_closest_face():
+    rng = np.random.RandomState(2)
+    A, B = rng.randn(3, 8).astype(np.float32), rng.randn(20, 8).astype(np.float32)
+    d = np.sqrt(((A[:, None, :] - B[None, :, :]) ** 2).sum(-1)).min(axis=0)
+    idx, _ = farthest_candidates(A, B, k=4, reduce='min')
+    assert idx.shape == (1, 4)
+    np.testing.assert_array_equal(idx[0], np.argsort(-d)[:4])
@@ -0,0 +1,80 @@
+import numpy as np
+
+from face_queue import FaceQueue
+
+
+class StubJob(object):
+    def __init__(self, nb_faces, value):
+        self.original_images = np.full((nb_faces, 2, 2, 3), value, dtype=np.float32)
+        self.target_embedding = np.full((nb_faces, 4), value, dtype=np.float32)
+
+
+def make_item(*groups):
+    return {"groups": [{"mode": mode, "job": StubJob(n, value), "protected": None}
+                       for mode, n, value in groups]}
+
+
+def test_packs_faces_across_items():
+    q = FaceQueue()
+    a, b = make_item(("low", 1, 1.0)), make_item(("low", 2, 2.0))
+    assert q.put(a) == 1
+    assert q.put(b) == 2
+    mode, batch = q.take(3)
+    assert mode == "low"
+    faces, targets = q.faces_of(batch)
+    assert faces.shape == (3, 2, 2, 3)
+    assert list(faces[:, 0, 0, 0]) == [1.0, 2.0, 2.0]
+    assert list(targets[:, 0]) == [1.0, 2.0, 2.0]
+    assert len(q) == 0
+
+
+def test_take_keeps_modes_apart_and_order():
+    q = FaceQueue()
+    q.put(make_item(("low", 1, 1.0), ("high", 1, 2.0)))
+    q.put(make_item(("low", 1, 3.0)))
+    mode, batch = q.take(4)
+    assert mode == "low"
+    assert [entry[1]["job"].original_images[0, 0, 0, 0] for entry in batch] == [1.0, 3.0]
+    mode, batch = q.take(4)
+    assert mode == "high"
+    assert len(batch) == 1
+
+
+def test_finish_scatters_and_completes_items():
+    q = FaceQueue()
+    a, b = make_item(("low", 2, 1.0)), make_item(("low", 1, 2.0))
+    q.put(a)
+    q.put(b)
+    _, batch = q.take(2)
+    protected = np.stack([np.full((2, 2, 3), 5.0), np.full((2, 2, 3), 6.0)])
+    assert q.finish(batch, protected, [10, 20]) == [a]
+    assert list(a["groups"][0]["protected"][:, 0, 0, 0]) == [5.0, 6.0]
+    assert a["groups"][0]["job"].iterations == [10, 20]
+    _, batch = q.take(2)
+    assert q.finish(batch, protected[:1], [7]) == [b]
+
+
+def test_failed_batch_drops_the_group():
+    q = FaceQueue()
+    a = make_item(("low", 2, 1.0))
+    q.put(a)
+    _, batch = q.take(1)
+    assert q.finish(batch) == []
+    _, batch = q.take(1)
+    assert q.finish(batch, np.zeros((1, 2, 2, 3)), [3]) == [a]
+    assert a["groups"][0]["protected"] is None
+
+
+def test_count():
+    assert FaceQueue.count(make_item(("low", 2, 1.0), ("high", 3, 1.0))) == 5
+    assert FaceQueue.count(make_item()) == 0
+
+
+def test_drain_returns_each_held_item_once():
+    q = FaceQueue()
+    a, b, c = make_item(("low", 2, 1.0)), make_item(("high", 1, 2.0), ("low", 2, 3.0)), make_item(("low", 1, 4.0))
+    for item in (a, b, c):
+        q.put(item)
+    q.take(2)
+    assert q.drain() == [b, c]
+    assert len(q) == 0
@@ -0,0 +1,95 @@
+import json
+import sys
+import types
+from concurrent.futures import Future
+
+try:
+    import google.cloud.firestore  # noqa: F401
+except ImportError:
+    # only Increment is used, and the test replaces it anyway
+    firestore = types.ModuleType("google.cloud.firestore")
+    firestore.Increment = None
+    sys.modules.setdefault("google", types.ModuleType("google"))
+    sys.modules.setdefault("google.cloud", types.ModuleType("google.cloud"))
+    sys.modules["google.cloud.firestore"] = firestore
+
+import firestore_results
+from firestore_results import commit_writes, publish_results
+
+
+class StubBatch(object):
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def update(self, ref, data):
+        self.ops.append(('update', ref, data))
+
+    def set(self, ref, data):
+        self.ops.append(('set', ref, data))
+
+    def commit(self):
+        self.db.committed.append(self.ops)
+
+
+class StubCollection(object):
+    def __init__(self, name):
+        self.name = name
+
+    def document(self, doc_id=None):
+        return (self.name, doc_id)
+
+
+class StubFirestore(object):
+    def __init__(self):
+        self.committed = []
+
+    def batch(self):
+        return StubBatch(self)
+
+    def collection(self, name):
+        return StubCollection(name)
+
+
+class StubUploader(object):
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.uploaded = []
+
+    def upload(self, bucket, key, data):
+        future = Future()
+        if key in self.failing:
+            future.set_exception(Exception("upload failed"))
+        else:
+            self.uploaded.append(key)
+            future.set_result(None)
+        return future
+
+
+def test_commit_writes_splits_at_the_batch_limit():
+    db = StubFirestore()
+    writes = [('set', i, {}) for i in range(5)] + [('update', 'user', {'n': -5})]
+    commit_writes(db, writes, limit=4)
+    assert [len(ops) for ops in db.committed] == [4, 2]
+    assert db.committed[1][-1] == ('update', 'user', {'n': -5})
+
+
+def test_publish_results_commits_once_per_batch(monkeypatch):
+    monkeypatch.setattr(firestore_results, "Increment", lambda value: ("increment", value))
+    db = StubFirestore()
+    uploader = StubUploader(failing=["processed/b.jpg"])
+    messages = [json.dumps({"uid": "u1", "imageUrl": "https://x/a.jpg"}),
+                json.dumps({"uid": "u1", "imageUrl": "https://x/b.jpg"}),
+                json.dumps({"uid": "u2", "imageUrl": "https://x/c.jpg"})]
+    jobs = [("trix", "a"), ("trix", "b"), ("trix", "c")]
+    publish_results(uploader, db, messages, jobs, {"a": b"A", "b": b"B"}, "https://cdn/")
+
+    assert uploader.uploaded == ["processed/a.jpg"]
+    assert len(db.committed) == 1
+    updates = [op for op in db.committed[0] if op[0] == 'update']
+    assert sorted((ref[1], data["unprocessedCount"]) for _, ref, data in updates) == \
+        [("u1", ("increment", -2)), ("u2", ("increment", -1))]
+    docs = {data["unalteredImageUrl"]: data["imageUrl"] for op, _, data in db.committed[0] if op == 'set'}
+    assert docs == {"https://x/a.jpg": "https://cdn/processed/a.jpg",
+                    "https://x/b.jpg": "https://x/b.jpg",
+                    "https://x/c.jpg": "https://x/c.jpg"}
@@ -0,0 +1,32 @@
+import json
+
+from fawkes.instrumentation import Instrumentation
+
+
+def test_prometheus_text_has_cumulative_buckets():
+    inst = Instrumentation(buckets=(0.1, 1.0))
+    inst.observe("attack", 0.05)
+    inst.observe("attack", 0.5)
+    inst.observe("attack", 5.0)
+    text = inst.prometheus_text()
+    assert '# TYPE fawkes_stage_seconds histogram' in text
+    assert 'fawkes_stage_seconds_bucket{stage="attack",le="0.1"} 1' in text
+    assert 'fawkes_stage_seconds_bucket{stage="attack",le="1.0"} 2' in text
+    assert 'fawkes_stage_seconds_bucket{stage="attack",le="+Inf"} 3' in text
+    assert 'fawkes_stage_seconds_sum{stage="attack"} 5.55' in text
+    assert 'fawkes_stage_seconds_count{stage="attack"} 3' in text
+
+
+def test_stage_records_carry_the_context(tmp_path):
+    path = str(tmp_path / "stages.jsonl")
+    inst = Instrumentation().configure(jsonl_path=path)
+    with inst.context(batch=7):
+        with inst.context(image="a.jpg"):
+            with inst.stage("detect", faces=2):
+                pass
+        inst.observe("upload", 0.25)
+    records = [json.loads(line) for line in open(path)]
+    assert [r["stage"] for r in records] == ["detect", "upload"]
+    assert records[0]["batch"] == 7 and records[0]["image"] == "a.jpg" and records[0]["faces"] == 2
+    assert "image" not in records[1] and records[1]["seconds"] == 0.25
+    assert inst.histograms["detect"].count == 1
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from fawkes.optimizers import SignedGradientOptimizer, learning_rate, make_optimizer
+
+
+def test_make_optimizer_by_name():
+    assert isinstance(make_optimizer('adadelta', 1.0), tf.train.AdadeltaOptimizer)
+    assert isinstance(make_optimizer('adam', 0.01), tf.train.AdamOptimizer)
+    assert isinstance(make_optimizer('sign', 0.01), SignedGradientOptimizer)
+    with pytest.raises(Exception):
+        make_optimizer('sgd', 0.01)
+
+
+def test_learning_rates():
+    assert learning_rate('adadelta', 20) == 20
+    assert learning_rate('adam', 20) == 0.01
+    assert learning_rate('sign', 20, 0.5) == 0.5
+
+
+def test_signed_steps_skip_zero_gradients():
+    with tf.Graph().as_default(), tf.Session() as sess:
+        var = tf.Variable(np.zeros(3, dtype=np.float32))
+        # positive, negative and zero gradients
+        loss = tf.reduce_sum(var * tf.constant([3.0, -0.001, 0.0]))
+        train = make_optimizer('sign', lambda: 0.5).minimize(loss, var_list=[var])
+        sess.run(tf.global_variables_initializer())
+        sess.run(train)
+        np.testing.assert_allclose(sess.run(var), [-0.5, 0.5, 0.0])
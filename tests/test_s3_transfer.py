@@ -0,0 +1,32 @@
+import io
+
+from s3_transfer import S3Downloader
+
+
+class StubS3(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.calls = []
+        self.bodies = []
+
+    def get_object(self, Bucket, Key):
+        self.calls.append(("get", Key))
+        etag, data = self.objects[Key]
+        self.bodies.append(io.BytesIO(data))
+        return {"ETag": etag, "Body": self.bodies[-1]}
+
+
+def test_one_request_per_object_and_skipped_bodies_are_not_read():
+    s3 = StubS3({"a": ('"1"', b"aa"), "b": ('"2"', b"bb")})
+    downloader = S3Downloader(s3, concurrency=1, retry_wait=0)
+    result = downloader.download([("bucket", "a"), ("bucket", "b")], skip=lambda key, etag: key == "a")
+    assert result == [('"1"', None), ('"2"', b"bb")]
+    assert s3.calls == [("get", "a"), ("get", "b")]
+    assert s3.bodies[0].closed
+
+
+def test_failed_download_returns_no_data():
+    s3 = StubS3({})
+    downloader = S3Downloader(s3, concurrency=1, retries=2, retry_wait=0)
+    assert downloader.download([("bucket", "missing")]) == [(None, None)]
+    assert s3.calls == [("get", "missing")] * 2
@@ -0,0 +1,53 @@
+from sqs_consumer import PrefetchingConsumer, VisibilityHeartbeat
+from stubs import StubSQS
+
+
+def test_prefetch_buffers_and_tracks_messages():
+    sqs = StubSQS(bodies=[{"n": i} for i in range(3)])
+    consumer = PrefetchingConsumer("queue", sqs=sqs, prefetch=5)
+    assert consumer._poll_once(10) == 3
+    assert consumer.heartbeat.in_flight == {"r0", "r1", "r2"}
+
+    batch = consumer.get_batch(2, timeout=0)
+    assert batch == {"messages": [{"n": 0}, {"n": 1}], "receipts": ["r0", "r1"]}
+    assert consumer.get_batch(5, timeout=0)["receipts"] == ["r2"]
+    assert consumer.get_batch(5, timeout=0) == {"messages": [], "receipts": []}
+
+
+def test_ack_deletes_in_chunks_of_ten_and_stops_extending():
+    sqs = StubSQS()
+    heartbeat = VisibilityHeartbeat(sqs, "queue")
+    receipts = ["r{}".format(i) for i in range(12)]
+    heartbeat.track(receipts)
+    heartbeat.ack(receipts)
+    assert sqs.deleted == receipts
+    assert heartbeat.in_flight == set()
+
+
+def test_release_makes_messages_visible_again():
+    sqs = StubSQS()
+    heartbeat = VisibilityHeartbeat(sqs, "queue")
+    heartbeat.track(["a", "b"])
+    heartbeat.release(["a"])
+    assert sqs.visibility == [("a", 0)]
+    assert heartbeat.in_flight == {"b"}
+
+
+def test_failed_extensions_are_forgotten():
+    sqs = StubSQS(failed_visibility=["gone"])
+    heartbeat = VisibilityHeartbeat(sqs, "queue", visibility_timeout=30)
+    heartbeat.track(["gone", "alive"])
+    heartbeat._change_visibility(sorted(heartbeat.in_flight), 30)
+    assert sqs.visibility == [("alive", 30)]
+    assert heartbeat.in_flight == {"alive"}
+
+
+def test_messages_past_max_age_stop_being_extended():
+    sqs = StubSQS()
+    heartbeat = VisibilityHeartbeat(sqs, "queue", max_age=60)
+    heartbeat.track(["old"])
+    heartbeat.tracked_at["old"] -= 120
+    heartbeat.track(["new"])
+    assert heartbeat._expire() == ["old"]
+    assert heartbeat.in_flight == {"new"}
+    assert VisibilityHeartbeat(sqs, "queue")._expire() == []
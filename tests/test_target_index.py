@@ -0,0 +1,63 @@
+import gzip
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from fawkes import target_index
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(target_index, "_indexes", {})
+    os.makedirs(target_index.model_dir())
+    return tmp_path
+
+
+def write_embeddings(embeddings, mtime):
+    path = target_index.embeddings_path("stub")
+    with gzip.open(path, 'wb') as f:
+        pickle.dump(embeddings, f)
+    os.utime(path, (mtime, mtime))
+
+
+def test_index_is_rebuilt_when_the_pickle_changes(home):
+    write_embeddings({1: np.ones(3), 2: np.zeros(3)}, mtime=1000)
+    index = target_index.load_embedding_index(["stub"])
+    assert sorted(index.ids) == [1, 2]
+    assert index.sq_norms[list(index.ids).index(1)] == 3.0
+
+    write_embeddings({1: np.ones(3), 2: np.zeros(3), 3: np.ones(3)}, mtime=2000)
+    target_index._indexes.clear()
+    assert sorted(target_index.load_embedding_index(["stub"]).ids) == [1, 2, 3]
+
+
+def test_index_without_its_pickle_is_kept(home):
+    write_embeddings({1: np.ones(3)}, mtime=1000)
+    directory = target_index.index_dir(["stub"])
+    target_index.build_embedding_index(["stub"], directory)
+    os.remove(target_index.embeddings_path("stub"))
+    assert target_index.index_is_current(directory, ["stub"])
+
+
+def test_no_temporary_files_are_left(home):
+    write_embeddings({1: np.ones(3)}, mtime=1000)
+    directory = target_index.index_dir(["stub"])
+    target_index.build_embedding_index(["stub"], directory)
+    assert not [name for name in os.listdir(directory) if name.endswith(".tmp")]
+
+
+def test_archive_of_another_index_is_not_used(home):
+    write_embeddings({1: np.ones(3), 2: np.zeros(3)}, mtime=1000)
+    directory = target_index.index_dir(["stub"])
+    index = target_index.build_embedding_index(["stub"], directory)
+    target_index.build_target_archive(index.ids, directory, target_root=str(home))
+    assert target_index.open_embedding_index(directory).targets is not None
+
+    write_embeddings({1: np.ones(3), 2: np.zeros(3), 3: np.ones(3)}, mtime=2000)
+    target_index.build_embedding_index(["stub"], directory)
+    reopened = target_index.open_embedding_index(directory)
+    assert reopened.targets is None
+    assert reopened.target_images(0) is None
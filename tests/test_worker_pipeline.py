@@ -0,0 +1,37 @@
+import threading
+
+from worker_pipeline import Pipeline
+
+
+def run_one(fn, item, **kwargs):
+    pipeline = Pipeline()
+    pipeline.add_stage("source", lambda: None)
+    stage = pipeline.add_stage("work", fn, **kwargs)
+    stage.start()
+    stage.inbox.put(item)
+    return stage
+
+
+def test_failed_item_goes_to_on_error():
+    failed = []
+    done = threading.Event()
+
+    def on_error(item):
+        failed.append(item)
+        done.set()
+
+    def boom(item):
+        raise ValueError("boom")
+
+    stage = run_one(boom, {"receipts": ["r"]}, on_error=on_error)
+    assert done.wait(5)
+    stage.stop()
+    assert failed == [{"receipts": ["r"]}]
+    assert stage.stats()["errors"] == 1
+
+
+def test_many_stage_passes_each_result_on():
+    stage = run_one(lambda item: iter([item, item + 1]), 1, many=True)
+    assert [stage.outbox.get(timeout=5) for _ in range(2)] == [1, 2]
+    stage.stop()
+    assert stage.outbox.empty()
@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+
+
+class Stage(object):
+    """One step of the worker pipeline.
+
+    `concurrency` threads pull items from `inbox`, call `fn(item)` and put the
+    result on `outbox`. Both queues are bounded, so a slow stage blocks the
+    ones feeding it instead of letting work pile up. A stage without an inbox
+    is a source: `fn()` is called in a loop and `None` results are dropped.
+    With `many`, `fn` returns an iterable and each result is passed on as
+    soon as it is produced, so a stage can hold items back or merge them.
+    When `fn` raises, the item is dropped and handed to `on_error`.
+    """
+
+    def __init__(self, name, fn, inbox=None, outbox=None, concurrency=1, many=False, on_error=None):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.concurrency = concurrency
+        self.many = many
+        self.on_error = on_error
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.blocked_time = 0.0
+        self.started_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self._run, name="{}-{}".format(self.name, i), daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _get(self):
+        while not self._stop.is_set():
+            try:
+                return self.inbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            if self.inbox is not None:
+                item = self._get()
+                if item is None:
+                    continue
+            got = time.perf_counter()
+            failed = False
+            try:
+                if self.inbox is None:
+                    out = self.fn()
+                else:
+                    out = self.fn(item)
+                if self.many:
+                    for result in out:
+                        if result is not None and self.outbox is not None:
+                            self.outbox.put(result)
+                    out = None
+            except Exception as e:
+                print("stage {} failed:".format(self.name), e)
+                out = None
+                failed = True
+                if self.on_error is not None and self.inbox is not None:
+                    try:
+                        self.on_error(item)
+                    except Exception as e:
+                        print("stage {} error handler failed:".format(self.name), e)
+            done = time.perf_counter()
+            if out is not None and self.outbox is not None:
+                self.outbox.put(out)
+            end = time.perf_counter()
+            with self._lock:
+                self.wait_time += got - start
+                self.busy_time += done - got
+                self.blocked_time += end - done
+                if failed:
+                    self.errors += 1
+                elif out is not None or self.outbox is None or self.many:
+                    self.processed += 1
+
+    def utilization(self):
+        # fraction of thread-time spent inside `fn`
+        if self.started_at is None:
+            return 0.0
+        elapsed = (time.perf_counter() - self.started_at) * self.concurrency
+        return self.busy_time / elapsed if elapsed > 0 else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {"stage": self.name,
+                    "concurrency": self.concurrency,
+                    "processed": self.processed,
+                    "errors": self.errors,
+                    "utilization": round(self.utilization(), 3),
+                    "busy_s": round(self.busy_time, 3),
+                    "waiting_s": round(self.wait_time, 3),
+                    "blocked_s": round(self.blocked_time, 3),
+                    "queued": self.inbox.qsize() if self.inbox is not None else 0}
+
+
+class Pipeline(object):
+    """Chains stages with bounded queues of size `queue_size`."""
+
+    def __init__(self, queue_size=2):
+        self.queue_size = queue_size
+        self.stages = []
+
+    def add_stage(self, name, fn, concurrency=1, many=False, on_error=None):
+        inbox = self.stages[-1].outbox if self.stages else None
+        stage = Stage(name, fn, inbox=inbox, outbox=queue.Queue(maxsize=self.queue_size),
+                      concurrency=concurrency, many=many, on_error=on_error)
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        # the last stage is a sink
+        self.stages[-1].outbox = None
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def report_forever(self, interval=60, reporters=None):
+        # `reporters` maps a name to a callable returning extra stats to print
+        while True:
+            time.sleep(interval)
+            for s in self.stats():
+                print("[pipeline] {stage}: util={utilization} processed={processed} errors={errors} "
+                      "queued={queued} busy={busy_s}s waiting={waiting_s}s blocked={blocked_s}s".format(**s))
+            for name, fn in (reporters or {}).items():
+                print("[{}]".format(name), fn())